@@ -0,0 +1,657 @@
+import argparse
+import collections
+import hashlib
+import http.server
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shlex
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from urllib.parse import unquote_plus
+
+import requests
+
+import migration
+
+# Offline benchmark for migration.py: a local stand-in for the GLPI REST API, a synthetic
+# osTicket v1.18 dataset (MySQL/MariaDB or a SQLite file) and a runner that reports
+# tickets/s, GLPI requests per ticket and peak RSS.
+
+CHUNK_SIZE = 256 * 1024  # osTicket stores database files in 256 KiB ost_file_chunk rows
+
+# Local GLPI API stand-in
+
+class FakeGLPIState:
+    # Users, ids and request counters shared by the handler threads of the fake server
+    # Items that the migration creates in bulk, which can be rejected or have their answer lost
+    BULK_ENDPOINTS = ('/ITILFollowup', '/Ticket_User', '/Document_Item')
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, error_status=503, reject_rate=0.0,
+                 lost_response_rate=0.0, seed=1):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.reject_rate = reject_rate
+        self.lost_response_rate = lost_response_rate
+        self.random = random.Random(seed)
+        # A few existing technician accounts, entities and categories for the mapping checks
+        self.users = {user_id: {'name': f"tech{user_id}", 'email': f"tech{user_id}@example.com"} for user_id in range(1, 11)}
+        self.entities = set(range(0, 11))
+        self.categories = set(range(1, 21))
+        self.ids = itertools.count(11)
+        self.requests = collections.Counter()
+        self.created = collections.Counter()
+        self.followup_documents = {}  # followup id -> [(Document_Item id, document id)] of inline uploads
+        self.bytes_received = 0
+        self.lock = threading.Lock()
+
+    def next_id(self):
+        with self.lock:
+            return next(self.ids)
+
+    def reset(self):
+        with self.lock:
+            self.requests.clear()
+            self.created.clear()
+            self.bytes_received = 0
+
+class FakeGLPIHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    state = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _endpoint(self):
+        path = self.path.split('?', 1)[0]
+        if '/apirest.php' in path:
+            path = path.split('/apirest.php', 1)[1]
+        return path.rstrip('/') or '/'
+
+    def _query(self):
+        query = self.path.split('?', 1)[1] if '?' in self.path else ''
+        return dict(
+            (unquote_plus(key), unquote_plus(value))
+            for key, _, value in (part.partition('=') for part in query.split('&') if part)
+        )
+
+    def _read_body(self):
+        # JSON bodies are kept, uploads are read in blocks and dropped except for their
+        # beginning, which holds the uploadManifest part
+        length = int(self.headers.get('Content-Length') or 0)
+        with self.state.lock:
+            self.state.bytes_received += length
+        if self.headers.get('Content-Type', '').startswith('application/json'):
+            return self.rfile.read(length)
+        head = b''
+        while length > 0:
+            chunk = self.rfile.read(min(length, 1024 * 1024))
+            if not chunk:
+                break
+            if len(head) < 65536:
+                head += chunk[:65536 - len(head)]
+            length -= len(chunk)
+        return head
+
+    def _upload_manifest(self, body):
+        # The JSON uploadManifest part of a multipart upload
+        start = body.find(b'name="uploadManifest"')
+        if start < 0:
+            return {}
+        start = body.index(b"\r\n\r\n", start) + 4
+        return json.loads(body[start:body.index(b"\r\n--", start)])
+
+    def _send(self, status, payload, headers=None):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _simulate(self, method, endpoint):
+        # Count the request, wait the configured latency and maybe inject an error.
+        # Returns True when an error response was sent.
+        state = self.state
+        key = f"{method} {migration.glpi_endpoint(endpoint)}"
+        with state.lock:
+            state.requests[key] += 1
+            delay = max(0.0, state.latency + state.random.uniform(-state.jitter, state.jitter))
+            fail = endpoint not in ('/initSession', '/killSession') and state.random.random() < state.error_rate
+        if delay:
+            time.sleep(delay)
+        if fail:
+            headers = {"Retry-After": "0"} if state.error_status == 429 else None
+            self._send(state.error_status, ["ERROR", "injected by benchmark"], headers)
+            return True
+        return False
+
+    def do_GET(self):
+        endpoint = self._endpoint()
+        if endpoint == '/_stats':
+            with self.state.lock:
+                return self._send(200, {'requests': dict(self.state.requests),
+                                        'created': dict(self.state.created),
+                                        'bytes_received': self.state.bytes_received})
+        if self._simulate("GET", endpoint):
+            return
+        if endpoint == '/initSession':
+            return self._send(200, {'session_token': hashlib.md5(str(self.state.next_id()).encode()).hexdigest()})
+        if endpoint == '/killSession':
+            return self._send(200, True)
+        if endpoint == '/search/User':
+            return self._search_users(self._query())
+        if endpoint.startswith('/ITILFollowup/') and endpoint.endswith('/Document_Item'):
+            with self.state.lock:
+                links = self.state.followup_documents.get(int(endpoint.split('/')[2]), [])
+            return self._send(200, [{'id': link_id, 'items_id': int(endpoint.split('/')[2]),
+                                     'itemtype': 'ITILFollowup', 'documents_id': document_id}
+                                    for link_id, document_id in links])
+        if endpoint in ('/Entity', '/ITILCategory', '/User'):
+            with self.state.lock:
+                ids = {'/Entity': self.state.entities, '/ITILCategory': self.state.categories,
+                       '/User': self.state.users}[endpoint]
+                ids = sorted(ids)
+            start, _, end = self._query().get('range', '0-49').partition('-')
+            page = ids[int(start):int(end) + 1]
+            return self._send(206 if len(page) < len(ids) else 200, [{'id': item_id} for item_id in page],
+                              {'Content-Range': f"{start}-{int(start) + max(len(page), 1) - 1}/{len(ids)}"})
+        return self._send(200, [])
+
+    def _search_users(self, params):
+        with self.state.lock:
+            users = sorted(self.state.users.items())
+        field = params.get('criteria[0][field]')
+        value = (params.get('criteria[0][value]') or '').lower()
+        if field == '5':
+            users = [(user_id, user) for user_id, user in users if value in user['email'].lower()]
+        elif field == '1':
+            users = [(user_id, user) for user_id, user in users if value in user['name'].lower()]
+        start, _, end = params.get('range', '0-49').partition('-')
+        page = users[int(start):int(end) + 1]
+        data = [{"1": user['name'], "2": user_id, "5": user['email']} for user_id, user in page]
+        return self._send(206 if len(page) < len(users) else 200,
+                          {'totalcount': len(users), 'count': len(data), 'data': data})
+
+    def do_POST(self):
+        endpoint = self._endpoint()
+        body = self._read_body()
+        if endpoint == '/_reset':
+            self.state.reset()
+            return self._send(200, True)
+        if self._simulate("POST", endpoint):
+            return
+        if endpoint == '/changeActiveEntities':
+            return self._send(200, True)
+        payload = {}
+        if self.headers.get('Content-Type', '').startswith('application/json') and body:
+            payload = json.loads(body)
+        elif body:
+            payload = self._upload_manifest(body)
+        items = payload.get('input', {})
+        results = [self._create(endpoint, item) for item in (items if isinstance(items, list) else [items])]
+        if endpoint == '/ITILFollowup' and not isinstance(items, list) and results[0]['id'] and items.get('_filename'):
+            # Files sent with a followup become documents linked to it, in the order of _filename
+            with self.state.lock:
+                self.state.followup_documents[results[0]['id']] = [
+                    (next(self.state.ids), next(self.state.ids)) for _ in items['_filename']
+                ]
+                self.state.created['/Document'] += len(items['_filename'])
+        with self.state.lock:
+            lost = endpoint in self.state.BULK_ENDPOINTS and self.state.random.random() < self.state.lost_response_rate
+        if lost:
+            # Created, but the answer is lost on the way back like behind a timing out proxy
+            return self._send(504, ["ERROR", "gateway timeout injected by benchmark"])
+        # Rejected items are reported the way GLPI's createItems does
+        if not isinstance(items, list):
+            if not results[0]['id']:
+                return self._send(400, ["ERROR_GLPI_ADD", results[0]['message']])
+            return self._send(201, results[0])
+        created = sum(1 for result in results if result['id'])
+        if created == len(results):
+            return self._send(201, results)
+        if created:
+            return self._send(207, ["ERROR_GLPI_PARTIAL_ADD", results])
+        return self._send(400, ["ERROR_GLPI_ADD", results])
+
+    def _create(self, endpoint, item):
+        with self.state.lock:
+            if endpoint in self.state.BULK_ENDPOINTS and self.state.random.random() < self.state.reject_rate:
+                return {'id': False, 'message': "rejected by benchmark"}
+            # Like GLPI, a login name can only be used once
+            if endpoint == '/User' and any(user['name'] == item.get('name') for user in self.state.users.values()):
+                return {'id': False, 'message': "Unable to add. The user already exists."}
+            self.state.created[endpoint] += 1
+            new_id = next(self.state.ids)
+            if endpoint == '/User':
+                self.state.users[new_id] = {'name': item.get('name', ''), 'email': item.get('email', '')}
+        return {'id': new_id, 'message': ''}
+
+    def do_PUT(self):
+        endpoint = self._endpoint()
+        self._read_body()
+        if self._simulate("PUT", endpoint):
+            return
+        return self._send(200, [{str(endpoint.rsplit('/', 1)[-1]): True, 'message': ''}])
+
+    def do_DELETE(self):
+        endpoint = self._endpoint()
+        if self._simulate("DELETE", endpoint):
+            return
+        return self._send(200, [{str(endpoint.rsplit('/', 1)[-1]): True, 'message': ''}])
+
+def start_fake_glpi(host="127.0.0.1", port=0, **state_options):
+    handler = type("Handler", (FakeGLPIHandler,), {'state': FakeGLPIState(**state_options)})
+    server = http.server.ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def serve_fake_glpi(port, ready, options):
+    server = start_fake_glpi(port=port, **options)
+    ready.put(server.server_port)
+    threading.Event().wait()
+
+# Synthetic osTicket dataset
+
+# Subset of the osTicket v1.18 schema with the columns migration.py reads, written so that
+# the same statements work on MySQL/MariaDB and SQLite
+OSTICKET_SCHEMA = [
+    """CREATE TABLE ost_user (
+        id INTEGER NOT NULL PRIMARY KEY, org_id INTEGER NOT NULL DEFAULT 0,
+        default_email_id INTEGER NOT NULL, status INTEGER NOT NULL DEFAULT 0,
+        name VARCHAR(128) NOT NULL, created DATETIME NOT NULL, updated DATETIME NOT NULL)""",
+    """CREATE TABLE ost_user_email (
+        id INTEGER NOT NULL PRIMARY KEY, user_id INTEGER NOT NULL, flags INTEGER NOT NULL DEFAULT 0,
+        address VARCHAR(255) NOT NULL)""",
+    "CREATE INDEX user_email_lookup ON ost_user_email (user_id)",
+    """CREATE TABLE ost_staff (
+        staff_id INTEGER NOT NULL PRIMARY KEY, dept_id INTEGER NOT NULL DEFAULT 0,
+        username VARCHAR(32) NOT NULL, firstname VARCHAR(32), lastname VARCHAR(32), email VARCHAR(255))""",
+    """CREATE TABLE ost_ticket (
+        ticket_id INTEGER NOT NULL PRIMARY KEY, number VARCHAR(20), user_id INTEGER NOT NULL DEFAULT 0,
+        user_email_id INTEGER NOT NULL DEFAULT 0, status_id INTEGER NOT NULL DEFAULT 0,
+        dept_id INTEGER NOT NULL DEFAULT 0, sla_id INTEGER NOT NULL DEFAULT 0,
+        topic_id INTEGER NOT NULL DEFAULT 0, staff_id INTEGER NOT NULL DEFAULT 0,
+        isanswered INTEGER NOT NULL DEFAULT 0, duedate DATETIME, closed DATETIME,
+        lastupdate DATETIME, created DATETIME NOT NULL, updated DATETIME NOT NULL)""",
+    """CREATE TABLE ost_ticket__cdata (
+        ticket_id INTEGER NOT NULL PRIMARY KEY, subject MEDIUMTEXT, priority MEDIUMTEXT)""",
+    """CREATE TABLE ost_thread (
+        id INTEGER NOT NULL PRIMARY KEY, object_id INTEGER NOT NULL, object_type CHAR(1) NOT NULL,
+        created DATETIME NOT NULL)""",
+    "CREATE INDEX thread_object ON ost_thread (object_type, object_id, id)",
+    """CREATE TABLE ost_thread_entry (
+        id INTEGER NOT NULL PRIMARY KEY, pid INTEGER NOT NULL DEFAULT 0, thread_id INTEGER NOT NULL,
+        staff_id INTEGER NOT NULL DEFAULT 0, user_id INTEGER NOT NULL DEFAULT 0, type CHAR(1) NOT NULL,
+        flags INTEGER NOT NULL DEFAULT 0, poster VARCHAR(128) NOT NULL, source VARCHAR(32) NOT NULL,
+        title VARCHAR(255), body LONGTEXT NOT NULL, format VARCHAR(16) NOT NULL DEFAULT 'html',
+        created DATETIME NOT NULL, updated DATETIME NOT NULL)""",
+    "CREATE INDEX thread_entry_created ON ost_thread_entry (thread_id, created, id)",
+    """CREATE TABLE ost_thread_collaborator (
+        id INTEGER NOT NULL PRIMARY KEY, flags INTEGER NOT NULL DEFAULT 1, thread_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL, role CHAR(1) NOT NULL DEFAULT 'M', created DATETIME NOT NULL,
+        updated DATETIME NOT NULL)""",
+    "CREATE UNIQUE INDEX collab ON ost_thread_collaborator (thread_id, user_id)",
+    """CREATE TABLE ost_file (
+        id INTEGER NOT NULL PRIMARY KEY, ft CHAR(1) NOT NULL DEFAULT 'T', bk CHAR(1) NOT NULL DEFAULT 'D',
+        type VARCHAR(255) NOT NULL, size BIGINT NOT NULL DEFAULT 0, `key` VARCHAR(86) NOT NULL,
+        signature VARCHAR(86) NOT NULL, name VARCHAR(255) NOT NULL, attrs VARCHAR(255),
+        created DATETIME NOT NULL)""",
+    """CREATE TABLE ost_file_chunk (
+        file_id INTEGER NOT NULL, chunk_id INTEGER NOT NULL, filedata LONGBLOB NOT NULL,
+        PRIMARY KEY (file_id, chunk_id))""",
+    """CREATE TABLE ost_attachment (
+        id INTEGER NOT NULL PRIMARY KEY, object_id INTEGER NOT NULL, type CHAR(1) NOT NULL,
+        file_id INTEGER NOT NULL, name VARCHAR(255), inline INTEGER NOT NULL DEFAULT 0, lang VARCHAR(16))""",
+    "CREATE UNIQUE INDEX attachment_file_type ON ost_attachment (object_id, file_id, type)",
+]
+
+OSTICKET_TABLES = ['ost_attachment', 'ost_file_chunk', 'ost_file', 'ost_thread_collaborator', 'ost_thread_entry',
+                   'ost_thread', 'ost_ticket__cdata', 'ost_ticket', 'ost_staff', 'ost_user_email', 'ost_user']
+
+class SQLiteCursor:
+    # Just enough of mysql.connector's dictionary cursor for migration.py to run on SQLite
+    def __init__(self, connection, dictionary):
+        self._cursor = connection.cursor()
+        self._dictionary = dictionary
+
+    def execute(self, query, params=()):
+        self._cursor.execute(query.replace('%s', '?'), tuple(params))
+
+    def _row(self, row):
+        if row is None or not self._dictionary:
+            return row
+        return dict(zip([column[0] for column in self._cursor.description], row))
+
+    def fetchone(self):
+        return self._row(self._cursor.fetchone())
+
+    def fetchall(self):
+        return [self._row(row) for row in self._cursor.fetchall()]
+
+    def close(self):
+        self._cursor.close()
+
+class SQLiteConnection:
+    def __init__(self, path):
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+
+    def cursor(self, dictionary=False, **kwargs):
+        return SQLiteCursor(self._connection, dictionary)
+
+    def close(self):
+        self._connection.close()
+
+def connect_dataset(options):
+    if options.sqlite:
+        return SQLiteConnection(options.sqlite)
+    return migration.mysql.connector.connect(**migration.osticket_db_config)
+
+def _insert(cursor, table, columns, rows):
+    # Dates are inserted as 'YYYY-MM-DD HH:MM:SS' strings, which both databases accept
+    rows[:] = [tuple(str(value) if isinstance(value, datetime) else value for value in row) for row in rows]
+    if rows:
+        quoted = ", ".join(f"`{column}`" for column in columns)
+        placeholders = ", ".join(["%s"] * len(columns))
+        query = f"INSERT INTO {table} ({quoted}) VALUES ({placeholders})"
+        if isinstance(cursor, SQLiteCursor):
+            cursor._cursor.executemany(query.replace('%s', '?'), rows)
+        else:
+            cursor.executemany(query, rows)
+        rows.clear()
+
+def generate_dataset(options):
+    # Fill the osTicket tables with a reproducible synthetic dataset. Entries per ticket are
+    # spread uniformly around --entries, attachment sizes follow a log-normal distribution
+    # around --attachment-kb and --duplicate-ratio of the attachments reuse shared files.
+    rng = random.Random(options.seed)
+    db = connect_dataset(options)
+    cursor = db.cursor()
+    for table in OSTICKET_TABLES:
+        cursor.execute(f"DROP TABLE IF EXISTS {table}")
+    for statement in OSTICKET_SCHEMA:
+        cursor.execute(statement)
+
+    start = datetime(2018, 1, 1)
+    users = max(1, options.users)
+    rows = collections.defaultdict(list)
+
+    def flush(force=False):
+        for table, table_rows in rows.items():
+            if force or len(table_rows) >= 1000:
+                _insert(cursor, table, COLUMNS[table], table_rows)
+        if force and not isinstance(cursor, SQLiteCursor):
+            db.commit()
+
+    for user_id in range(1, users + 1):
+        rows['ost_user'].append((user_id, user_id, f"User {user_id}", start, start))
+        rows['ost_user_email'].append((user_id, user_id, f"user{user_id}@example.com"))
+    for staff_id in range(1, options.staff + 1):
+        rows['ost_staff'].append((staff_id, f"agent{staff_id}", "Agent", str(staff_id), f"agent{staff_id}@example.com"))
+
+    shared_files = []
+    ids = collections.Counter()
+    attachments_dir = options.attachments_dir
+    for ticket_id in range(1, options.tickets + 1):
+        created = start + timedelta(minutes=ticket_id * 37)
+        user_id = rng.randint(1, users)
+        staff_id = rng.randint(0, options.staff) if options.staff else 0
+        closed = created + timedelta(days=2) if rng.random() < 0.8 else None
+        entries = rng.randint(1, max(1, 2 * options.entries - 1))
+        lastupdate = created + timedelta(hours=entries)
+        rows['ost_ticket'].append((ticket_id, f"{ticket_id:06d}", user_id, 0, 3 if closed else 1, 1, 0, 1,
+                                   staff_id, 1, None, closed, lastupdate, created, lastupdate))
+        rows['ost_ticket__cdata'].append((ticket_id, f"Synthetic ticket {ticket_id}", "2"))
+        rows['ost_thread'].append((ticket_id, ticket_id, 'T', created))
+        for collaborator in rng.sample(range(1, users + 1), min(users, rng.randint(0, options.collaborators))):
+            ids['collaborator'] += 1
+            rows['ost_thread_collaborator'].append((ids['collaborator'], ticket_id, collaborator, 'M', created, created))
+
+        for index in range(entries):
+            ids['entry'] += 1
+            entry_id = ids['entry']
+            from_staff = index % 2 == 1 and staff_id
+            body = "<p>" + ("Lorem ipsum dolor sit amet. " * rng.randint(5, options.body_words // 5 + 5)) + "</p>"
+            entry_created = created + timedelta(hours=index)
+            rows['ost_thread_entry'].append((entry_id, ticket_id, staff_id if from_staff else 0,
+                                             0 if from_staff else user_id, 'R' if from_staff else 'M',
+                                             "Agent" if from_staff else f"User {user_id}", 'Email', body,
+                                             entry_created, entry_created))
+
+            for _ in range(options.attachments if rng.random() < options.attachment_ratio else 0):
+                if shared_files and rng.random() < options.duplicate_ratio:
+                    file_id = rng.choice(shared_files)
+                else:
+                    ids['file'] += 1
+                    file_id = ids['file']
+                    size = max(1, int(rng.lognormvariate(0, options.attachment_sigma) * options.attachment_kb * 1024))
+                    content = rng.randbytes(size)
+                    signature = hashlib.sha1(content).hexdigest()
+                    key = hashlib.md5(f"{file_id}".encode()).hexdigest()
+                    on_disk = attachments_dir and rng.random() < options.filesystem_ratio
+                    rows['ost_file'].append((file_id, 'T', 'F' if on_disk else 'D', 'application/pdf', size, key,
+                                             signature, f"file-{file_id}.pdf", '', entry_created))
+                    if on_disk:
+                        os.makedirs(os.path.join(attachments_dir, key[:1]), exist_ok=True)
+                        with open(os.path.join(attachments_dir, key[:1], key), 'wb') as file:
+                            file.write(content)
+                    else:
+                        for chunk_id, offset in enumerate(range(0, size, CHUNK_SIZE)):
+                            rows['ost_file_chunk'].append((file_id, chunk_id, content[offset:offset + CHUNK_SIZE]))
+                    if len(shared_files) < 50:
+                        shared_files.append(file_id)
+                ids['attachment'] += 1
+                rows['ost_attachment'].append((ids['attachment'], entry_id, 'H', file_id, None, 0, None))
+        flush()
+    flush(force=True)
+    if isinstance(cursor, SQLiteCursor):
+        db._connection.commit()
+    db.close()
+    return {'tickets': options.tickets, 'entries': ids['entry'], 'files': ids['file'],
+            'attachments': ids['attachment'], 'collaborators': ids['collaborator']}
+
+COLUMNS = {
+    'ost_user': ('id', 'default_email_id', 'name', 'created', 'updated'),
+    'ost_user_email': ('id', 'user_id', 'address'),
+    'ost_staff': ('staff_id', 'username', 'firstname', 'lastname', 'email'),
+    'ost_ticket': ('ticket_id', 'number', 'user_id', 'user_email_id', 'status_id', 'dept_id', 'sla_id', 'topic_id',
+                   'staff_id', 'isanswered', 'duedate', 'closed', 'lastupdate', 'created', 'updated'),
+    'ost_ticket__cdata': ('ticket_id', 'subject', 'priority'),
+    'ost_thread': ('id', 'object_id', 'object_type', 'created'),
+    'ost_thread_collaborator': ('id', 'thread_id', 'user_id', 'role', 'created', 'updated'),
+    'ost_thread_entry': ('id', 'thread_id', 'staff_id', 'user_id', 'type', 'poster', 'source', 'body',
+                         'created', 'updated'),
+    'ost_file': ('id', 'ft', 'bk', 'type', 'size', 'key', 'signature', 'name', 'attrs', 'created'),
+    'ost_file_chunk': ('file_id', 'chunk_id', 'filedata'),
+    'ost_attachment': ('id', 'object_id', 'type', 'file_id', 'name', 'inline', 'lang'),
+}
+
+# Runner
+
+def _run_migration(options, glpi_url, migration_argv, state_dir, result_queue):
+    # Runs in a child process so its peak RSS is not mixed up with the fake server or the generator
+    migration.glpi_url = glpi_url
+    if options.sqlite:
+        migration.connect_osticket_db = lambda: SQLiteConnection(options.sqlite)
+    if options.attachments_dir:
+        migration.osticket_attachments_dir = options.attachments_dir
+    args = migration.parse_args([
+        '--state', os.path.join(state_dir, 'state.db'),
+        '--metrics-report', os.path.join(state_dir, 'metrics.json'),
+        '--progress-interval', '0',
+        *migration_argv
+    ])
+    start = time.monotonic()
+    if args.shards > 1:
+        migration.run_shards(args)
+    else:
+        migration.main(args)
+    elapsed = time.monotonic() - start
+    with open(os.path.join(state_dir, 'metrics.json')) as file:
+        report = json.load(file)
+    result_queue.put({
+        'elapsed_seconds': elapsed,
+        # With --shards the shard processes are children of this one
+        'peak_rss_mb': max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                           resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024,
+        'report': report
+    })
+
+def run_benchmark(options):
+    if options.generate:
+        print(f"Generated dataset: {generate_dataset(options)}")
+
+    ready = multiprocessing.Queue()
+    server_options = {'latency': options.latency, 'jitter': options.jitter,
+                      'error_rate': options.error_rate, 'error_status': options.error_status,
+                      'reject_rate': options.reject_rate, 'lost_response_rate': options.lost_response_rate}
+    server = multiprocessing.Process(target=serve_fake_glpi, args=(0, ready, server_options), daemon=True)
+    server.start()
+    glpi_url = f"http://127.0.0.1:{ready.get(timeout=30)}/apirest.php"
+
+    try:
+        with tempfile.TemporaryDirectory() as state_dir:
+            results = multiprocessing.Queue()
+            child = multiprocessing.Process(target=_run_migration, args=(
+                options, glpi_url, shlex.split(options.migration_args), state_dir, results))
+            child.start()
+            child.join()
+            if child.exitcode != 0:
+                raise SystemExit(f"Migration process failed with exit code {child.exitcode}")
+            outcome = results.get(timeout=10)
+        stats = requests.get(f"{glpi_url}/_stats", timeout=30).json()
+    finally:
+        server.terminate()
+
+    report = outcome['report']
+    tickets = report['tickets']['migrated'] + report['tickets']['failed']
+    glpi_requests = sum(stats['requests'].values())
+    summary = {
+        'tickets': tickets,
+        'elapsed_seconds': round(outcome['elapsed_seconds'], 3),
+        'tickets_per_second': round(tickets / outcome['elapsed_seconds'], 3) if outcome['elapsed_seconds'] else 0,
+        'requests_per_ticket': round(glpi_requests / tickets, 3) if tickets else 0,
+        'glpi_requests': glpi_requests,
+        'glpi_bytes_received': stats['bytes_received'],
+        'peak_rss_mb': round(outcome['peak_rss_mb'], 1),
+        'requests_by_endpoint': dict(sorted(stats['requests'].items())),
+        'created_by_endpoint': dict(sorted(stats['created'].items())),
+        'settings': {
+            'migration_args': options.migration_args,
+            'latency': options.latency,
+            'error_rate': options.error_rate,
+            'reject_rate': options.reject_rate,
+            'lost_response_rate': options.lost_response_rate,
+        },
+        'migration_report': report
+    }
+    return summary
+
+def print_summary(summary, baseline=None):
+    print(f"Tickets:            {summary['tickets']}")
+    print(f"Elapsed:            {summary['elapsed_seconds']:.2f}s")
+    for key, label, higher_is_better in (('tickets_per_second', "Tickets/s", True),
+                                         ('requests_per_ticket', "Requests/ticket", False),
+                                         ('peak_rss_mb', "Peak RSS (MB)", False)):
+        line = f"{label + ':':<20}{summary[key]}"
+        if baseline and baseline.get(key):
+            change = (summary[key] - baseline[key]) / baseline[key] * 100
+            worse = change < 0 if higher_is_better else change > 0
+            line += f"  ({change:+.1f}% vs baseline{', REGRESSION' if worse and abs(change) > 5 else ''})"
+        print(line)
+    for endpoint, count in summary['requests_by_endpoint'].items():
+        print(f"  {endpoint:<32}{count}")
+    print("Items created:")
+    for endpoint, count in summary['created_by_endpoint'].items():
+        print(f"  {endpoint:<32}{count}")
+
+def add_dataset_arguments(parser):
+    parser.add_argument("--sqlite", default=None,
+                        help="use this SQLite file as the osTicket database instead of MySQL/MariaDB "
+                             "(MySQL uses osticket_db_config from migration.py)")
+    parser.add_argument("--attachments-dir", default=None,
+                        help="directory for filesystem-stored attachments (osTicket's attachments/ folder)")
+    parser.add_argument("--tickets", type=int, default=1000)
+    parser.add_argument("--entries", type=int, default=5, help="average thread entries per ticket")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--staff", type=int, default=10)
+    parser.add_argument("--collaborators", type=int, default=2, help="maximum collaborators per ticket")
+    parser.add_argument("--body-words", type=int, default=200, help="approximate words per thread entry body")
+    parser.add_argument("--attachment-ratio", type=float, default=0.2,
+                        help="fraction of thread entries with attachments")
+    parser.add_argument("--attachments", type=int, default=1, help="attachments per entry that has attachments")
+    parser.add_argument("--attachment-kb", type=float, default=64, help="median attachment size in KiB")
+    parser.add_argument("--attachment-sigma", type=float, default=1.0,
+                        help="spread of the log-normal attachment size distribution")
+    parser.add_argument("--duplicate-ratio", type=float, default=0.1,
+                        help="fraction of attachments that reuse an already stored file")
+    parser.add_argument("--filesystem-ratio", type=float, default=0.5,
+                        help="fraction of files stored on disk when --attachments-dir is set")
+    parser.add_argument("--seed", type=int, default=1)
+
+def add_server_arguments(parser):
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every GLPI response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random +/- seconds around --latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with an error")
+    parser.add_argument("--error-status", type=int, default=503, help="HTTP status used for injected errors")
+    parser.add_argument("--reject-rate", type=float, default=0.0,
+                        help="fraction of followups, watchers and document links refused (207/400 answers)")
+    parser.add_argument("--lost-response-rate", type=float, default=0.0,
+                        help="fraction of followup, watcher and document link POSTs answered with 504 "
+                             "after the items were created")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmark for the osTicket to GLPI migration")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve = commands.add_parser("serve", help="run the local GLPI API stand-in")
+    serve.add_argument("--port", type=int, default=8080)
+    add_server_arguments(serve)
+
+    generate = commands.add_parser("generate", help="fill an osTicket database with synthetic data")
+    add_dataset_arguments(generate)
+
+    run = commands.add_parser("run", help="migrate the synthetic dataset into the GLPI stand-in and report")
+    add_dataset_arguments(run)
+    add_server_arguments(run)
+    run.add_argument("--generate", action="store_true", help="(re)generate the dataset before running")
+    run.add_argument("--migration-args", default="", help="extra migration.py options, e.g. \"--workers 8\"")
+    run.add_argument("--output", default=None, help="write the results as JSON to this file")
+    run.add_argument("--baseline", default=None, help="JSON results of an earlier run to compare with")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    options = parse_args(argv)
+    if options.command == "serve":
+        server = start_fake_glpi(port=options.port, latency=options.latency, jitter=options.jitter,
+                                 error_rate=options.error_rate, error_status=options.error_status,
+                                 reject_rate=options.reject_rate, lost_response_rate=options.lost_response_rate)
+        print(f"Fake GLPI API listening on http://127.0.0.1:{server.server_port}/apirest.php")
+        threading.Event().wait()
+    elif options.command == "generate":
+        print(f"Generated dataset: {generate_dataset(options)}")
+    else:
+        summary = run_benchmark(options)
+        baseline = None
+        if options.baseline:
+            with open(options.baseline) as file:
+                baseline = json.load(file)
+        print_summary(summary, baseline)
+        if options.output:
+            with open(options.output, 'w') as file:
+                json.dump(summary, file, indent=2, default=str)
+
+if __name__ == "__main__":
+    main()
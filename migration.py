@@ -1,24 +1,175 @@
 import mysql.connector
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
 import json
 import os
 import base64
+import gzip
+import hashlib
+import contextlib
 import mimetypes
-from datetime import datetime
+import bisect
+import random
+import argparse
+import multiprocessing
+import tempfile
+import collections
+from concurrent.futures import Future
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+class MigrationMetrics:
+    # Thread-safe count, bytes and latency histogram per stage. Stages are named
+    # "mysql.<function>" for osTicket queries and "glpi.<METHOD> <endpoint>" for API calls.
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def _entry(self, stage):
+        entry = self.stages.get(stage)
+        if entry is None:
+            entry = self.stages[stage] = {
+                'count': 0, 'seconds': 0.0, 'max': 0.0, 'bytes': 0,
+                'histogram': [0] * (len(self.BUCKETS) + 1)
+            }
+        return entry
+
+    def record(self, stage, seconds, nbytes=0):
+        with self._lock:
+            entry = self._entry(stage)
+            entry['count'] += 1
+            entry['seconds'] += seconds
+            entry['max'] = max(entry['max'], seconds)
+            entry['bytes'] += nbytes
+            entry['histogram'][bisect.bisect_left(self.BUCKETS, seconds)] += 1
+
+    def merge(self, summary):
+        # Add the stages of another run's summary(), e.g. read from a shard's report
+        with self._lock:
+            for stage, other in summary.items():
+                entry = self._entry(stage)
+                entry['count'] += other['count']
+                entry['seconds'] += other['total_seconds']
+                entry['max'] = max(entry['max'], other['max_seconds'])
+                entry['bytes'] += other['bytes']
+                entry['histogram'] = [a + b for a, b in zip(entry['histogram'], other['histogram'].values())]
+
+    @contextlib.contextmanager
+    def timed(self, stage):
+        # The yielded dict can be given a 'bytes' value before the block ends
+        measured = {'bytes': 0}
+        start = time.monotonic()
+        try:
+            yield measured
+        finally:
+            self.record(stage, time.monotonic() - start, measured['bytes'])
+
+    def _percentile(self, entry, fraction):
+        # Upper bound of the bucket holding the given fraction of the samples
+        target = entry['count'] * fraction
+        seen = 0
+        for index, count in enumerate(entry['histogram']):
+            seen += count
+            if seen >= target and count:
+                return self.BUCKETS[index] if index < len(self.BUCKETS) else entry['max']
+        return entry['max']
+
+    def summary(self):
+        with self._lock:
+            stages = {stage: dict(entry, histogram=list(entry['histogram'])) for stage, entry in self.stages.items()}
+        return {
+            stage: {
+                'count': entry['count'],
+                'bytes': entry['bytes'],
+                'total_seconds': round(entry['seconds'], 3),
+                'mean_seconds': round(entry['seconds'] / entry['count'], 4) if entry['count'] else 0,
+                'p50_seconds': self._percentile(entry, 0.5),
+                'p95_seconds': self._percentile(entry, 0.95),
+                'p99_seconds': self._percentile(entry, 0.99),
+                'max_seconds': round(entry['max'], 4),
+                'histogram': dict(zip([f"<={bucket}" for bucket in self.BUCKETS] + ["inf"], entry['histogram']))
+            }
+            for stage, entry in sorted(stages.items())
+        }
+
+metrics = MigrationMetrics()
+
+def _rows_bytes(rows):
+    return sum(len(value) for row in rows for value in row.values() if isinstance(value, (str, bytes, bytearray)))
+
+def timed_fetchall(stage, cursor, query, params=()):
+    with metrics.timed(stage) as measured:
+        cursor.execute(query, params)
+        rows = cursor.fetchall()
+        measured['bytes'] = _rows_bytes(rows)
+    return rows
+
+# OsTicket database connection settings
+osticket_db_config = {
+    "host": "localhost",
+    "user": "",
+    "password": "",
+    "database": "osticket"
+}
+
+# Every thread (main thread and each migration worker) gets its own MySQL connection
+_thread_state = threading.local()
+
+def connect_osticket_db():
+    return mysql.connector.connect(**osticket_db_config)
+
+def get_osticket_db():
+    if getattr(_thread_state, 'osticket_db', None) is None:
+        _thread_state.osticket_db = connect_osticket_db()
+    return _thread_state.osticket_db
 
-# OsTicket database connection
-osticket_db = mysql.connector.connect(
-    host="localhost",
-    user="",
-    password="",
-    database="osticket"
-)
+def close_osticket_db():
+    db = getattr(_thread_state, 'osticket_db', None)
+    if db is not None:
+        db.close()
+        _thread_state.osticket_db = None
 
 # GLPI API configuration
 glpi_url = "https://tickets.url/apirest.php"
 glpi_app_token = ""
 glpi_user_token = ""
 
+# Where osTicket's filesystem storage plugin keeps attachments
+osticket_attachments_dir = '/opt/osticket/data/attachments/'
+
+# Send attachments as streamed multipart uploads instead of reading them fully into memory
+stream_attachments = False
+file_stream_chunk_size = 256 * 1024
+
+# Attachments read ahead on background threads while the previous ones upload; files larger
+# than attachment_prefetch_max_file are streamed during the upload instead
+attachment_prefetcher = None
+attachment_prefetch_max_file = 8 * 1024 * 1024
+
+# Set when importing an archive made by export_archive; attachment rows then point to its blobs
+archive_dir = None
+
+# A delta sync (the sync command) picks up changes made up to this many seconds before the
+# previous run started, so rows committed while it was reading are not missed
+sync_overlap = 300
+
+# Upload each distinct file once and only link it again when it shows up in other thread entries
+deduplicate_attachments = True
+
+# Send a followup's attachments inside the ITILFollowup POST instead of as Document + Document_Item
+inline_attachments = False
+
+# Followups, watchers and document links sent per POST (GLPI accepts a list of inputs), 1 = one per request
+bulk_write_size = 50
+
 # Mapping of OsTicket department IDs to GLPI entity IDs
 department_to_entity_map = {
     # Example: 1: 5 means OsTicket department ID 1 maps to GLPI entity ID 5
@@ -37,79 +188,264 @@ staff_to_technician_map = {
     1: 3,
 }
 
-def get_osticket_tickets():
-    cursor = osticket_db.cursor(dictionary=True)
-    query = """
+def osticket_tickets_query(ranged=False, id_count=0):
+    # One row of scalar fields per ticket, for tickets that have a thread. The description is
+    # not part of it: it is the body of the first thread entry, which get_ticket_threads reads
+    # anyway (see ticket_with_body), so the biggest text column is read only once.
+    # The requester email is the one used on the ticket (or the user's default email).
+    # A ranged query takes (first_id, last_id) twice and limits the thread derived table to
+    # that ticket_id range. With id_count the query takes a list of id_count ticket ids twice instead.
+    ticket_range = "WHERE t.ticket_id BETWEEN %s AND %s" if ranged else ""
+    thread_range = "AND object_id BETWEEN %s AND %s" if ranged else ""
+    if id_count:
+        placeholders = ', '.join(['%s'] * id_count)
+        ticket_range = f"WHERE t.ticket_id IN ({placeholders})"
+        thread_range = f"AND object_id IN ({placeholders})"
+    return f"""
     SELECT t.ticket_id, t.number, t.user_id, t.user_email_id, t.status_id, t.dept_id,
        t.topic_id, t.staff_id, t.isanswered, t.duedate, t.closed, t.lastupdate, t.created,
        tc.subject, tc.priority, t.sla_id,
-       (SELECT te.body
-        FROM ost_thread_entry te
-        INNER JOIN ost_thread ON (ost_thread.id = te.thread_id)
-        INNER JOIN ost_ticket ON (ost_ticket.ticket_id = ost_thread.object_id)
-        WHERE ost_ticket.ticket_id = t.ticket_id
-        ORDER BY te.created LIMIT 1) AS ticket_body,
        u.name AS requester_name, ue.address AS requester_email
     FROM ost_ticket t
+    JOIN (
+        SELECT object_id, MIN(id) AS id
+        FROM ost_thread
+        WHERE object_type = 'T' {thread_range}
+        GROUP BY object_id
+    ) th ON th.object_id = t.ticket_id
     LEFT JOIN ost_ticket__cdata tc ON t.ticket_id = tc.ticket_id
     LEFT JOIN ost_user u ON t.user_id = u.id
-    LEFT JOIN ost_user_email ue ON t.user_id = ue.user_id
-    JOIN ost_thread th ON t.ticket_id = th.object_id
-    WHERE th.object_type = 'T'
+    LEFT JOIN ost_user_email ue ON ue.id = COALESCE(NULLIF(t.user_email_id, 0), u.default_email_id)
+    {ticket_range}
+    ORDER BY t.ticket_id
     """
-    # This can be added to the Where syntax to segment migration
-    # AND t.ticket_id > 499 AND t.ticket_id < 10001
-    cursor.execute(query)
-    return cursor.fetchall()
+
+def iter_osticket_tickets(from_id=None, to_id=None, chunk_size=500):
+    # Stream tickets in keyset-paginated chunks ordered by ticket_id, so only one chunk
+    # is held in memory. Each chunk is fully read before it is yielded, which leaves the
+    # connection free for the batch prefetch queries in between.
+    cursor = get_osticket_db().cursor(dictionary=True)
+    last_id = from_id - 1 if from_id is not None else -1
+    while True:
+        query = "SELECT ticket_id FROM ost_ticket WHERE ticket_id > %s"
+        params = [last_id]
+        if to_id is not None:
+            query += " AND ticket_id <= %s"
+            params.append(to_id)
+        query += " ORDER BY ticket_id LIMIT %s"
+        params.append(chunk_size)
+        ticket_ids = [row['ticket_id'] for row in timed_fetchall("mysql.get_osticket_ticket_ids", cursor, query, tuple(params))]
+        if not ticket_ids:
+            return
+
+        page_range = (ticket_ids[0], ticket_ids[-1])
+        for ticket in timed_fetchall("mysql.get_osticket_tickets", cursor, osticket_tickets_query(ranged=True), page_range * 2):
+            yield ticket
+        last_id = ticket_ids[-1]
+
+def osticket_sync_mark():
+    # High-water mark for the next delta sync: osTicket's own clock (so the migration host's
+    # clock does not matter) minus sync_overlap, which catches rows committed late
+    cursor = get_osticket_db().cursor(dictionary=True)
+    now = timed_fetchall("mysql.osticket_sync_mark", cursor, "SELECT CURRENT_TIMESTAMP AS now")[0]['now']
+    if isinstance(now, str):
+        now = datetime.strptime(now, "%Y-%m-%d %H:%M:%S")
+    return str(now - timedelta(seconds=sync_overlap))
+
+def changed_osticket_ticket_ids(since, from_id=None, to_id=None):
+    # Tickets updated, or with thread entries created or edited, since the high-water mark.
+    # Three selects instead of one OR, so each can use its index from osticket_indexes.sql.
+    cursor = get_osticket_db().cursor(dictionary=True)
+    query = """
+    SELECT ticket_id FROM ost_ticket WHERE lastupdate >= %s
+    UNION
+    SELECT th.object_id FROM ost_thread_entry te
+    JOIN ost_thread th ON th.id = te.thread_id AND th.object_type = 'T'
+    WHERE te.created >= %s
+    UNION
+    SELECT th.object_id FROM ost_thread_entry te
+    JOIN ost_thread th ON th.id = te.thread_id AND th.object_type = 'T'
+    WHERE te.updated >= %s
+    """
+    rows = timed_fetchall("mysql.changed_osticket_ticket_ids", cursor, query, (since,) * 3)
+    return sorted(
+        row['ticket_id'] for row in rows
+        if (from_id is None or row['ticket_id'] >= from_id) and (to_id is None or row['ticket_id'] <= to_id)
+    )
+
+def iter_osticket_tickets_by_id(ticket_ids, chunk_size=500):
+    cursor = get_osticket_db().cursor(dictionary=True)
+    for start in range(0, len(ticket_ids), chunk_size):
+        chunk = ticket_ids[start:start + chunk_size]
+        query = osticket_tickets_query(id_count=len(chunk))
+        for ticket in timed_fetchall("mysql.get_osticket_tickets", cursor, query, tuple(chunk) * 2):
+            yield ticket
+
+def count_osticket_tickets(from_id=None, to_id=None):
+    cursor = get_osticket_db().cursor(dictionary=True)
+    query = "SELECT COUNT(*) AS total FROM ost_ticket WHERE ticket_id >= %s"
+    params = [from_id if from_id is not None else 0]
+    if to_id is not None:
+        query += " AND ticket_id <= %s"
+        params.append(to_id)
+    return timed_fetchall("mysql.count_osticket_tickets", cursor, query, tuple(params))[0]['total']
+
+def explain_osticket_tickets(chunk_size=500):
+    # Print the execution plan of one page of the ticket query and warn about full scans
+    # on the big tables, which means the indexes in osticket_indexes.sql are missing
+    cursor = get_osticket_db().cursor(dictionary=True)
+    cursor.execute("EXPLAIN " + osticket_tickets_query(ranged=True), (0, chunk_size) * 2)
+    plan = cursor.fetchall()
+    ok = True
+    for row in plan:
+        print(f"{row.get('id')} {row.get('select_type')} {row.get('table')} type={row.get('type')} "
+              f"key={row.get('key')} rows={row.get('rows')} extra={row.get('Extra')}")
+        # Only the ost_thread read inside the grouped derived table matters, the <derivedN> row
+        # is always a scan of the already limited result
+        if row.get('type') == 'ALL' and row.get('table') == 'ost_thread':
+            print(f"  Full scan on {row.get('table')}, apply osticket_indexes.sql")
+            ok = False
+    return ok
 
 def get_osticket_tickets_first_entry(ticket_id):
-    cursor = osticket_db.cursor(dictionary=True)
+    cursor = get_osticket_db().cursor(dictionary=True)
     query = """
     SELECT te.body
         FROM ost_thread_entry te
         INNER JOIN ost_thread ON (ost_thread.id = te.thread_id)
         INNER JOIN ost_ticket ON (ost_ticket.ticket_id = ost_thread.object_id)
-        WHERE ost_ticket.ticket_id = %s
-        ORDER BY te.created LIMIT 1
+        WHERE ost_ticket.ticket_id = %s AND ost_thread.object_type = 'T'
+        ORDER BY te.created, te.id LIMIT 1
     """
-    cursor.execute(query)
-    return cursor.fetchall()
-
-def get_ticket_threads(ticket_id):
-    cursor = osticket_db.cursor(dictionary=True)
+    return timed_fetchall("mysql.get_osticket_tickets_first_entry", cursor, query, (ticket_id,))
+
+def ticket_with_body(ticket, threads=None):
+    # The ticket with its description (ticket_body), taken from the first thread entry.
+    # threads are the ticket's entries as get_ticket_threads returns them; without them the
+    # first entry is read on its own.
+    if threads is None:
+        first_entry = get_osticket_tickets_first_entry(ticket['ticket_id'])
+    else:
+        first_entry = threads[:1]
+    return dict(ticket, ticket_body=first_entry[0]['body'] if first_entry else None)
+
+# Small osTicket dimension tables, loaded once so that thread entries and collaborators
+# get their staff and user names from memory instead of joining ost_staff, ost_user and
+# ost_user_email on every query
+osticket_staff = {}  # staff_id -> {'firstname': ..., 'lastname': ...}
+osticket_users = {}  # user_id -> {'name': ..., 'email': default email, else the first one}
+_osticket_dimensions_loaded = False
+_osticket_dimensions_lock = threading.Lock()
+
+def load_osticket_dimensions():
+    global _osticket_dimensions_loaded
+    if _osticket_dimensions_loaded:
+        return
+    with _osticket_dimensions_lock:
+        if _osticket_dimensions_loaded:
+            return
+        cursor = get_osticket_db().cursor(dictionary=True)
+        staff = {
+            row['staff_id']: {'firstname': row['firstname'], 'lastname': row['lastname']}
+            for row in timed_fetchall("mysql.load_osticket_dimensions", cursor,
+                                      "SELECT staff_id, firstname, lastname FROM ost_staff")
+        }
+        users = {}
+        default_emails = {}
+        for row in timed_fetchall("mysql.load_osticket_dimensions", cursor,
+                                  "SELECT id, name, default_email_id FROM ost_user"):
+            users[row['id']] = {'name': row['name'], 'email': None}
+            default_emails[row['id']] = row['default_email_id']
+        for row in timed_fetchall("mysql.load_osticket_dimensions", cursor,
+                                  "SELECT id, user_id, address FROM ost_user_email ORDER BY id"):
+            user = users.get(row['user_id'])
+            if user is not None and (user['email'] is None or row['id'] == default_emails[row['user_id']]):
+                user['email'] = row['address']
+        osticket_staff.update(staff)
+        osticket_users.update(users)
+        _osticket_dimensions_loaded = True
+
+def get_osticket_staff(staff_id):
+    # Staff added to osTicket after the load (the migration can run for days) are read on
+    # their first use and kept
+    if not staff_id:
+        return {}
+    staff = osticket_staff.get(staff_id)
+    if staff is None:
+        cursor = get_osticket_db().cursor(dictionary=True)
+        rows = timed_fetchall("mysql.get_osticket_staff", cursor,
+                              "SELECT firstname, lastname FROM ost_staff WHERE staff_id = %s", (staff_id,))
+        staff = osticket_staff[staff_id] = rows[0] if rows else {}
+    return staff
+
+def get_osticket_user(user_id):
+    # Same for users, with their default email (else the first one) as in the load
+    if not user_id:
+        return {}
+    user = osticket_users.get(user_id)
+    if user is None:
+        cursor = get_osticket_db().cursor(dictionary=True)
+        query = """
+        SELECT u.name, ue.address
+        FROM ost_user u
+        LEFT JOIN ost_user_email ue ON ue.user_id = u.id
+        WHERE u.id = %s
+        ORDER BY ue.id = u.default_email_id DESC, ue.id
+        LIMIT 1
+        """
+        rows = timed_fetchall("mysql.get_osticket_user", cursor, query, (user_id,))
+        user = osticket_users[user_id] = {'name': rows[0]['name'], 'email': rows[0]['address']} if rows else {}
+    return user
+
+def add_entry_people(rows):
+    load_osticket_dimensions()
+    for row in rows:
+        staff = get_osticket_staff(row['staff_id'])
+        user = get_osticket_user(row['user_id'])
+        row['staff_firstname'] = staff.get('firstname')
+        row['staff_lastname'] = staff.get('lastname')
+        row['user_name'] = user.get('name')
+        row['user_email'] = user.get('email')
+    return rows
+
+def collaborator_row(row):
+    load_osticket_dimensions()
+    user = get_osticket_user(row['user_id'])
+    return {'email': user.get('email'), 'role': row['role'], 'name': user.get('name')}
+
+def get_ticket_threads(ticket_id, batch=None):
+    if batch is not None:
+        return batch['threads'].get(ticket_id, [])
+    cursor = get_osticket_db().cursor(dictionary=True)
     query = """
     SELECT te.id, te.thread_id, te.staff_id, te.user_id, te.type, te.poster,
            te.body, te.created, te.updated, te.source, te.flags,
-           t.object_id, t.object_type,
-           s.firstname AS staff_firstname, s.lastname AS staff_lastname,
-           u.name AS user_name, ue.address AS user_email
+           t.object_id, t.object_type
     FROM ost_thread_entry te
     JOIN ost_thread t ON te.thread_id = t.id
-    LEFT JOIN ost_staff s ON te.staff_id = s.staff_id
-    LEFT JOIN ost_user u ON te.user_id = u.id
-    LEFT JOIN ost_user_email ue ON u.id = ue.user_id
     WHERE t.object_id = %s AND t.object_type = 'T'
-    ORDER BY te.created ASC
+    ORDER BY te.created ASC, te.id ASC
     """
-    cursor.execute(query, (ticket_id,))
-    return cursor.fetchall()
+    return add_entry_people(timed_fetchall("mysql.get_ticket_threads", cursor, query, (ticket_id,)))
 
-def get_ticket_collaborators(ticket_id):
-    cursor = osticket_db.cursor(dictionary=True)
+def get_ticket_collaborators(ticket_id, batch=None):
+    if batch is not None:
+        return batch['collaborators'].get(ticket_id, [])
+    cursor = get_osticket_db().cursor(dictionary=True)
     query = """
-    SELECT ue.address as email, tc.role, u.name
+    SELECT tc.user_id, tc.role
     FROM ost_thread_collaborator tc
     JOIN ost_thread t ON tc.thread_id = t.id
-    JOIN ost_user u ON tc.user_id = u.id
-    JOIN ost_user_email ue ON u.id = ue.user_id
     WHERE t.object_id = %s AND t.object_type = 'T'
     """
-    cursor.execute(query, (ticket_id,))
-    return cursor.fetchall()
+    rows = timed_fetchall("mysql.get_ticket_collaborators", cursor, query, (ticket_id,))
+    return [collaborator for collaborator in map(collaborator_row, rows) if collaborator['email']]
 
-def get_osticket_attachments(thread_entry_id):
+def get_osticket_attachments(thread_entry_id, batch=None):
     #print(thread_entry_id)
-    cursor = osticket_db.cursor(dictionary=True)
+    if batch is not None:
+        return batch['attachments'].get(thread_entry_id, [])
+    cursor = get_osticket_db().cursor(dictionary=True)
     query = """
     SELECT a.id, a.object_id, a.type, a.file_id, a.name as attachment_name, a.inline, a.lang,
            f.ft, f.bk, f.type as file_type, f.size, f.key, f.signature, f.name as file_name, f.attrs, f.created, te.created as created_date
@@ -119,22 +455,86 @@ def get_osticket_attachments(thread_entry_id):
     WHERE te.id = %s AND a.type = 'H'
     ORDER BY te.created ASC
     """
-    cursor.execute(query, (thread_entry_id,))
-    return cursor.fetchall()
+    return timed_fetchall("mysql.get_osticket_attachments", cursor, query, (thread_entry_id,))
+
+def prefetch_ticket_batch(ticket_ids):
+    # Fetch threads, collaborators and attachment metadata for a whole batch of tickets
+    # in three queries, grouped in memory by ticket_id and thread entry id
+    batch = {
+        'threads': {ticket_id: [] for ticket_id in ticket_ids},
+        'collaborators': {ticket_id: [] for ticket_id in ticket_ids},
+        'attachments': {}
+    }
+    if not ticket_ids:
+        return batch
+
+    cursor = get_osticket_db().cursor(dictionary=True)
+    placeholders = ", ".join(["%s"] * len(ticket_ids))
+
+    query = f"""
+    SELECT te.id, te.thread_id, te.staff_id, te.user_id, te.type, te.poster,
+           te.body, te.created, te.updated, te.source, te.flags,
+           t.object_id, t.object_type
+    FROM ost_thread_entry te
+    JOIN ost_thread t ON te.thread_id = t.id
+    WHERE t.object_id IN ({placeholders}) AND t.object_type = 'T'
+    ORDER BY t.object_id, te.created ASC, te.id ASC
+    """
+    for row in add_entry_people(timed_fetchall("mysql.prefetch_threads", cursor, query, tuple(ticket_ids))):
+        batch['threads'][row['object_id']].append(row)
+
+    query = f"""
+    SELECT t.object_id AS ticket_id, tc.user_id, tc.role
+    FROM ost_thread_collaborator tc
+    JOIN ost_thread t ON tc.thread_id = t.id
+    WHERE t.object_id IN ({placeholders}) AND t.object_type = 'T'
+    """
+    for row in timed_fetchall("mysql.prefetch_collaborators", cursor, query, tuple(ticket_ids)):
+        collaborator = collaborator_row(row)
+        if collaborator['email']:
+            batch['collaborators'][row['ticket_id']].append(collaborator)
+
+    query = f"""
+    SELECT a.id, a.object_id, a.type, a.file_id, a.name as attachment_name, a.inline, a.lang,
+           f.ft, f.bk, f.type as file_type, f.size, f.key, f.signature, f.name as file_name, f.attrs, f.created, te.created as created_date
+    FROM ost_thread t
+    JOIN ost_thread_entry te ON te.thread_id = t.id
+    JOIN ost_attachment a ON a.object_id = te.id
+    JOIN ost_file f ON a.file_id = f.id
+    WHERE t.object_id IN ({placeholders}) AND t.object_type = 'T' AND a.type = 'H'
+    ORDER BY te.created ASC
+    """
+    for row in timed_fetchall("mysql.prefetch_attachments", cursor, query, tuple(ticket_ids)):
+        batch['attachments'].setdefault(row['object_id'], []).append(row)
+
+    return batch
+
+def get_file_content(file_id, file_info=None):
+    with metrics.timed("mysql.get_file_content") as measured:
+        content = read_file_content(file_id, file_info)
+        measured['bytes'] = len(content) if content else 0
+    return content
 
-def get_file_content(file_id):
-    cursor = osticket_db.cursor(dictionary=True)
+def read_file_content(file_id, file_info=None):
+    if file_info is not None and 'blob' in file_info:
+        return read_archive_blob(file_info['blob'])
+    cursor = None
 
     # First, check if the file is stored in the filesystem
-    query = "SELECT bk, `key` FROM ost_file WHERE id = %s"
-    cursor.execute(query, (file_id,))
-    result = cursor.fetchone()
+    # (attachment rows already carry bk and key, so callers can pass them to skip this query)
+    if file_info is not None:
+        result = file_info
+    else:
+        cursor = get_osticket_db().cursor(dictionary=True)
+        query = "SELECT bk, `key` FROM ost_file WHERE id = %s"
+        cursor.execute(query, (file_id,))
+        result = cursor.fetchone()
 
     if result and result['bk'] == 'F':  # 'F' typically indicates filesystem storage
         # File is stored in the filesystem
         file_key = result['key']
         # Construct the file path based on osTicket's file storage structure
-        file_path = os.path.join('/opt/osticket/data/attachments/', file_key[:1], file_key)
+        file_path = osticket_file_path(file_key)
         try:
             with open(file_path, 'rb') as file:
                 return file.read()
@@ -143,6 +543,7 @@ def get_file_content(file_id):
             return None
     else:
         # File is stored in the database
+        cursor = cursor or get_osticket_db().cursor(dictionary=True)
         query = """
         SELECT filedata
         FROM ost_file_chunk
@@ -153,20 +554,550 @@ def get_file_content(file_id):
         chunks = cursor.fetchall()
         return b''.join(chunk['filedata'] for chunk in chunks)
 
-def init_glpi_session():
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"user_token {glpi_user_token}",
-        "App-Token": glpi_app_token
-    }
-    response = requests.get(f"{glpi_url}/initSession", headers=headers)
+def osticket_file_path(file_key):
+    # Construct the file path based on osTicket's file storage structure
+    return os.path.join(osticket_attachments_dir, file_key[:1], file_key)
+
+class FileStream:
+    # File content of known size that is read in chunks each time it is iterated,
+    # so only one chunk is in memory and an upload can be retried from the start
+    def __init__(self, size, read_chunks):
+        self.size = size
+        self._read_chunks = read_chunks
+
+    def __iter__(self):
+        sent = 0
+        for chunk in self._read_chunks():
+            sent += len(chunk)
+            yield chunk
+        if sent != self.size:
+            raise IOError(f"File changed while streaming: expected {self.size} bytes, read {sent}")
+
+def stream_file_content(file_id, file_info=None):
+    # Same lookup as get_file_content, but returns a FileStream instead of the content
+    if file_info is not None and 'blob' in file_info:
+        if file_info['blob'] is None:
+            return None
+        return stream_local_file(archive_blob_path(file_info['blob']))
+    if file_info is not None:
+        result = file_info
+    else:
+        cursor = get_osticket_db().cursor(dictionary=True)
+        query = "SELECT bk, `key` FROM ost_file WHERE id = %s"
+        cursor.execute(query, (file_id,))
+        result = cursor.fetchone()
+
+    if result and result['bk'] == 'F':
+        return stream_local_file(osticket_file_path(result['key']))
+
+    # Database chunks are fetched one row per query, so the connection is never left
+    # with an unread result set while the upload is in flight
+    cursor = get_osticket_db().cursor(dictionary=True)
+    query = """
+    SELECT chunk_id, LENGTH(filedata) AS length
+    FROM ost_file_chunk
+    WHERE file_id = %s
+    ORDER BY chunk_id
+    """
+    cursor.execute(query, (file_id,))
+    chunks = cursor.fetchall()
+
+    def read_chunks():
+        chunk_cursor = get_osticket_db().cursor(dictionary=True)
+        for chunk in chunks:
+            chunk_cursor.execute("SELECT filedata FROM ost_file_chunk WHERE file_id = %s AND chunk_id = %s",
+                                 (file_id, chunk['chunk_id']))
+            yield chunk_cursor.fetchone()['filedata']
+
+    return FileStream(sum(chunk['length'] for chunk in chunks), read_chunks)
+
+def stream_local_file(file_path):
+    try:
+        size = os.path.getsize(file_path)
+    except FileNotFoundError:
+        print(f"File not found: {file_path}")
+        return None
+
+    def read_file():
+        with open(file_path, 'rb') as file:
+            while True:
+                chunk = file.read(file_stream_chunk_size)
+                if not chunk:
+                    return
+                yield chunk
+
+    return FileStream(size, read_file)
+
+def archive_blob_path(blob, base_dir=None):
+    return os.path.join(base_dir or archive_dir, 'blobs', blob[:2], blob)
+
+def read_archive_blob(blob):
+    if blob is None:
+        return None
+    try:
+        with open(archive_blob_path(blob), 'rb') as file:
+            return file.read()
+    except FileNotFoundError:
+        print(f"Blob not found: {archive_blob_path(blob)}")
+        return None
+
+def export_blob(base_dir, attachment):
+    # Copy the attachment content into blobs/<sha256[:2]>/<sha256>, streaming it through
+    # a temporary file so only one chunk is in memory; returns the hash, or None if missing
+    file_stream = stream_file_content(attachment['file_id'], attachment)
+    if file_stream is None:
+        return None
+    digest = hashlib.sha256()
+    temp_path = os.path.join(base_dir, 'blobs', f".tmp-{threading.get_ident()}")
+    with open(temp_path, 'wb') as file:
+        for chunk in file_stream:
+            digest.update(chunk)
+            file.write(chunk)
+    blob = digest.hexdigest()
+    blob_path = archive_blob_path(blob, base_dir)
+    if os.path.exists(blob_path):
+        os.remove(temp_path)
+    else:
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        os.replace(temp_path, blob_path)
+    return blob
+
+def load_attachment_content(attachment, contents=None):
+    # Content of an attachment as bytes or as a FileStream, from the read-ahead when there is one
+    if contents is not None:
+        return contents.get(attachment)
+    if stream_attachments or (attachment.get('size') or 0) > attachment_prefetch_max_file:
+        return stream_file_content(attachment['file_id'], attachment)
+    return get_file_content(attachment['file_id'], attachment)
+
+class AttachmentPrefetcher:
+    # Reads attachment content on a few background threads so disk and MySQL reads overlap
+    # the uploads. At most max_bytes of content is read ahead, shared by all workers.
+    def __init__(self, threads=4, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._used = 0
+        self._lock = threading.Lock()
+        self._tasks = queue.Queue()
+        self._threads = [threading.Thread(target=self._read_loop, daemon=True) for _ in range(threads)]
+        for thread in self._threads:
+            thread.start()
+
+    def _read_loop(self):
+        # Each reader has its own MySQL connection through get_osticket_db
+        try:
+            while True:
+                task = self._tasks.get()
+                if task is None:
+                    return
+                attachment, future = task
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    future.set_result(get_file_content(attachment['file_id'], attachment))
+                except Exception as e:
+                    future.set_exception(e)
+        finally:
+            close_osticket_db()
+
+    def reserve(self, size):
+        with self._lock:
+            if self._used + size > self.max_bytes:
+                return False
+            self._used += size
+            return True
+
+    def release(self, size):
+        with self._lock:
+            self._used -= size
+
+    def submit(self, attachment):
+        future = Future()
+        self._tasks.put((attachment, future))
+        return future
+
+    def prefetch(self, attachments):
+        return PrefetchedAttachments(self, attachments)
+
+    def close(self):
+        for _ in self._threads:
+            self._tasks.put(None)
+        for thread in self._threads:
+            thread.join()
+
+class PrefetchedAttachments:
+    # Read-ahead of one ticket's attachments. get() may be called in any order, attachments
+    # that were not read ahead yet (no room in the budget, or too large) are read on the spot.
+    def __init__(self, prefetcher, attachments):
+        self._prefetcher = prefetcher
+        self._pending = collections.deque(
+            attachment for attachment in attachments
+            if not stream_attachments and (attachment.get('size') or 0) <= attachment_prefetch_max_file
+        )
+        self._futures = {}
+        self._fill()
+
+    def _fill(self):
+        while self._pending:
+            size = self._pending[0].get('size') or 0
+            if not self._prefetcher.reserve(size):
+                return
+            attachment = self._pending.popleft()
+            self._futures[attachment['id']] = (self._prefetcher.submit(attachment), size)
+
+    def get(self, attachment):
+        entry = self._futures.pop(attachment['id'], None)
+        if entry is None:
+            self._pending = collections.deque(a for a in self._pending if a['id'] != attachment['id'])
+            return load_attachment_content(attachment)
+        future, size = entry
+        try:
+            return future.result()
+        finally:
+            self._prefetcher.release(size)
+            self._fill()
+
+    def close(self):
+        # Give back the budget of everything that was read ahead but not used
+        self._pending.clear()
+        for future, size in self._futures.values():
+            future.cancel()
+            future.add_done_callback(lambda _, size=size: self._prefetcher.release(size))
+        self._futures.clear()
+
+class MultipartStream:
+    # multipart/form-data body for GLPI uploads that streams the file parts. Having both
+    # __len__ and __iter__ makes requests send a Content-Length and iterate the body.
+    # files is a list of (field, file name, mime type, FileStream or bytes).
+    def __init__(self, fields, files):
+        self.boundary = uuid.uuid4().hex
+        head = b''
+        for name, value in fields.items():
+            head += (f"--{self.boundary}\r\n"
+                     f"Content-Disposition: form-data; name=\"{name}\"\r\n"
+                     f"Content-Type: application/json\r\n\r\n").encode() + value.encode() + b"\r\n"
+        self._parts = []
+        for file_field, file_name, file_mime, content in files:
+            quoted_name = file_name.replace('\\', '\\\\').replace('"', '%22').replace('\r', '%0D').replace('\n', '%0A')
+            head += (f"--{self.boundary}\r\n"
+                     f"Content-Disposition: form-data; name=\"{file_field}\"; filename=\"{quoted_name}\"\r\n"
+                     f"Content-Type: {file_mime}\r\n\r\n").encode()
+            self._parts.append((head, content))
+            head = b"\r\n"
+        self._tail = head + f"--{self.boundary}--\r\n".encode()
+
+    @property
+    def content_type(self):
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def __len__(self):
+        return sum(len(head) + (content.size if isinstance(content, FileStream) else len(content))
+                   for head, content in self._parts) + len(self._tail)
+
+    def __iter__(self):
+        for head, content in self._parts:
+            yield head
+            if isinstance(content, FileStream):
+                yield from content
+            else:
+                yield content
+        yield self._tail
+
+def make_http_session(pool_size=10):
+    # One pooled keep-alive HTTP session that every GLPI client shares, so TLS connections
+    # to GLPI are reused instead of opened for every call
+    http = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+    http.mount("http://", adapter)
+    http.mount("https://", adapter)
+    return http
+
+_default_http = None
+_default_http_lock = threading.Lock()
+
+def get_default_http_session():
+    global _default_http
+    with _default_http_lock:
+        if _default_http is None:
+            _default_http = make_http_session()
+        return _default_http
+
+class RequestScheduler:
+    # Shared by every GLPI client. Each request waits for a token from a token bucket
+    # (rate requests/s, up to burst at once) and for a free slot under the concurrency
+    # limit. Timeouts, connection errors, 429 and 502/503/504 are retried with jittered
+    # exponential backoff (honouring Retry-After). Requests that are not idempotent (POST,
+    # PUT, DELETE) may already have been carried out after a read timeout, a dropped
+    # connection or a gateway error, so they are only retried when GLPI never got them
+    # (connect timeout, connection refused) or refused them (429, 503). The concurrency limit
+    # grows while GLPI answers faster than target_latency and halves when it is slow or pushes back.
+    RETRY_STATUS = (429, 502, 503, 504)
+    RETRY_STATUS_NOT_IDEMPOTENT = (429, 503)
+
+    def __init__(self, rate=0, burst=None, max_retries=5, backoff_base=0.5, backoff_max=30,
+                 max_concurrency=8, target_latency=1.0, timeout=(10, 120)):
+        self.rate = rate
+        self.burst = (burst or max(1, int(rate))) if rate else 1
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_concurrency = max_concurrency
+        self.target_latency = target_latency
+        self.timeout = timeout
+        self.limit = float(max_concurrency)
+        self.stats = {'requests': 0, 'retries': 0, 'throttled': 0, 'gave_up': 0}
+        self._tokens = float(self.burst)
+        self._refilled = time.monotonic()
+        self._last_decrease = 0
+        self._in_flight = 0
+        self._condition = threading.Condition()
+
+    def _take_token(self):
+        if not self.rate:
+            return
+        while True:
+            with self._condition:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rate)
+                self._refilled = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def _acquire_slot(self):
+        with self._condition:
+            while self._in_flight >= int(self.limit):
+                self._condition.wait()
+            self._in_flight += 1
+
+    def _release_slot(self, latency, overloaded):
+        with self._condition:
+            self._in_flight -= 1
+            now = time.monotonic()
+            if overloaded or latency > 2 * self.target_latency:
+                # At most one decrease per target_latency, so one slow burst doesn't collapse the limit
+                if now - self._last_decrease > self.target_latency:
+                    self.limit = max(1.0, self.limit / 2)
+                    self._last_decrease = now
+            elif latency < self.target_latency:
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+    def _backoff(self, attempt, response=None):
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return min(self.backoff_max, int(retry_after))
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    @staticmethod
+    def _not_sent(error):
+        # True when the request cannot have reached GLPI
+        if isinstance(error, requests.ConnectTimeout):
+            return True
+        reason = getattr(error.args[0], 'reason', None) if error.args else None
+        return isinstance(reason, NewConnectionError)
+
+    def execute(self, send, idempotent=True):
+        # send(timeout) performs one attempt; the last response is returned once the
+        # retries are exhausted, or the last exception is raised
+        retry_status = self.RETRY_STATUS if idempotent else self.RETRY_STATUS_NOT_IDEMPOTENT
+        for attempt in range(self.max_retries + 1):
+            self._take_token()
+            self._acquire_slot()
+            start = time.monotonic()
+            response = None
+            try:
+                with self._condition:
+                    self.stats['requests'] += 1
+                response = send(self.timeout)
+            except (requests.Timeout, requests.ConnectionError) as e:
+                self._release_slot(time.monotonic() - start, True)
+                if attempt == self.max_retries or not (idempotent or self._not_sent(e)):
+                    with self._condition:
+                        self.stats['gave_up'] += 1
+                    raise
+            except BaseException:
+                # Anything else (a broken chunked response, a failing file reader behind a
+                # streamed body...) is not retried, but must not keep its slot
+                self._release_slot(time.monotonic() - start, False)
+                with self._condition:
+                    self.stats['gave_up'] += 1
+                raise
+            else:
+                overloaded = response.status_code in self.RETRY_STATUS
+                self._release_slot(time.monotonic() - start, overloaded)
+                if response.status_code not in retry_status:
+                    return response
+                if attempt == self.max_retries:
+                    with self._condition:
+                        self.stats['gave_up'] += 1
+                    return response
+                if response.status_code == 429:
+                    with self._condition:
+                        self.stats['throttled'] += 1
+            with self._condition:
+                self.stats['retries'] += 1
+            time.sleep(self._backoff(attempt, response))
+
+_default_scheduler = RequestScheduler()
+
+def glpi_endpoint(path):
+    # "/Document/123" -> "/Document", so metrics group calls by endpoint
+    return "/" + "/".join(part for part in path.strip("/").split("/") if part and not part.isdigit())
+
+class GLPIClient:
+    # GLPI REST API client for one GLPI session: holds the app and session tokens
+    # and sends every call through a pooled requests.Session and the request scheduler
+    def __init__(self, http=None, session_token=None, scheduler=None):
+        self.http = http or get_default_http_session()
+        self.session_token = session_token
+        self.scheduler = scheduler or _default_scheduler
+
+    def headers(self, json_content=True):
+        headers = {"App-Token": glpi_app_token}
+        if self.session_token:
+            headers["Session-Token"] = self.session_token
+        if json_content:
+            headers["Content-Type"] = "application/json"
+        return headers
+
+    def request(self, method, path, headers=None, **kwargs):
+        # Multipart uploads set their own Content-Type
+        json_content = 'files' not in kwargs and 'data' not in kwargs
+        headers = {**self.headers(json_content), **(headers or {})}
+        with metrics.timed(f"glpi.{method} {glpi_endpoint(path)}") as measured:
+            response = self.scheduler.execute(
+                lambda timeout: self.http.request(method, f"{glpi_url}{path}", headers=headers, timeout=timeout, **kwargs),
+                idempotent=method == "GET"
+            )
+            measured['bytes'] = int(response.request.headers.get('Content-Length') or 0) + len(response.content)
+        return response
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def put(self, path, **kwargs):
+        return self.request("PUT", path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.request("DELETE", path, **kwargs)
+
+class DryRunPlan:
+    # Tally of what a --dry-run would have sent to GLPI, shared by every worker's DryRunClient
+    def __init__(self):
+        self.requests = collections.Counter()
+        self.bytes = collections.Counter()
+        self.upload_bytes = 0
+        self.item_files = {}  # made-up id -> files uploaded with that item
+        self._last_id = 0
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, nbytes, upload=False):
+        with self._lock:
+            self.requests[endpoint] += 1
+            self.bytes[endpoint] += nbytes
+            if upload:
+                self.upload_bytes += nbytes
+
+    def new_ids(self, count):
+        with self._lock:
+            self._last_id += count
+            return list(range(self._last_id - count + 1, self._last_id + 1))
+
+    def estimate(self, latencies, elapsed, workers, rate=None):
+        # Seconds the writes would have added to this run: each planned request costs the mean
+        # latency of its endpoint (or of every GLPI call when the endpoint was never measured),
+        # spread over the workers and no faster than the rate limit allows
+        fallback = [stage for stage in latencies.values() if stage['count']]
+        default = (sum(stage['total_seconds'] for stage in fallback) / sum(stage['count'] for stage in fallback)
+                   if fallback else 0)
+        writes = {endpoint: count for endpoint, count in self.requests.items() if not endpoint.startswith("GET ")}
+        seconds = sum(count * latencies.get(f"glpi.{endpoint}", {}).get('mean_seconds', default)
+                      for endpoint, count in writes.items())
+        estimate = elapsed + seconds / max(1, workers)
+        if rate:
+            estimate = max(estimate, sum(self.requests.values()) / rate)
+        return estimate
+
+    def summary(self):
+        with self._lock:
+            return {
+                'requests': dict(sorted(self.requests.items())),
+                'bytes': dict(sorted(self.bytes.items())),
+                'upload_bytes': self.upload_bytes
+            }
+
+class DryRunClient(GLPIClient):
+    # GLPIClient for --dry-run: reads (sessions, user searches, validation) still go to GLPI,
+    # writes are only counted in the plan and answered with made-up ids so the migration
+    # carries on exactly as it would
+    def __init__(self, plan, http=None, session_token=None, scheduler=None):
+        super().__init__(http, session_token, scheduler)
+        self.plan = plan
+
+    def request(self, method, path, headers=None, **kwargs):
+        endpoint = f"{method} {glpi_endpoint(path)}"
+        upload = 'files' in kwargs or 'data' in kwargs
+        item_id = path.split("/")[2] if path.count("/") >= 3 else None
+        if method == "GET" and item_id and item_id.isdigit() and int(item_id) in self.plan.item_files:
+            # Documents of an inline followup of this dry run, never sent to GLPI
+            self.plan.record(endpoint, 0)
+            response = requests.Response()
+            response.status_code = 200
+            response.headers['Content-Type'] = "application/json"
+            response._content = json.dumps([
+                {"id": link_id, "documents_id": document_id} for link_id, document_id in
+                zip(self.plan.new_ids(self.plan.item_files[int(item_id)]),
+                    self.plan.new_ids(self.plan.item_files[int(item_id)]))
+            ]).encode()
+            return response
+        if method == "GET":
+            response = super().request(method, path, headers, **kwargs)
+            self.plan.record(endpoint, int(response.request.headers.get('Content-Length') or 0))
+            return response
+        # Prepared but never sent, for the Content-Length a real request would have
+        prepared = requests.Request(method, f"{glpi_url}{path}", headers={**self.headers(not upload), **(headers or {})},
+                                    **kwargs).prepare()
+        self.plan.record(endpoint, int(prepared.headers.get('Content-Length') or 0), upload)
+        response = requests.Response()
+        response.request = prepared
+        response.url = prepared.url
+        response.status_code = 200
+        content = True
+        if method == "POST" and not path.startswith("/changeActiveEntities"):
+            response.status_code = 201
+            items = (kwargs.get('json') or {}).get('input')
+            if isinstance(items, list):
+                content = [{"id": item_id, "message": ""} for item_id in self.plan.new_ids(len(items))]
+            else:
+                content = {"id": self.plan.new_ids(1)[0], "message": ""}
+                if isinstance(kwargs.get('data'), MultipartStream):
+                    self.plan.item_files[content['id']] = len(kwargs['data']._parts)
+        response.headers['Content-Type'] = "application/json"
+        response._content = json.dumps(content).encode()
+        return response
+
+# Set by --dry-run, makes every GLPI session a DryRunClient
+dry_run_plan = None
+
+def init_glpi_session(http=None, scheduler=None):
+    if dry_run_plan is not None:
+        glpi = DryRunClient(dry_run_plan, http, scheduler=scheduler)
+    else:
+        glpi = GLPIClient(http, scheduler=scheduler)
+    response = glpi.get("/initSession", headers={"Authorization": f"user_token {glpi_user_token}"})
     print(f"Status Code: {response.status_code}")
     print(f"Response Headers: {response.headers}")
     print(f"Response Content: {response.text}")
 
     if response.status_code == 200:
         try:
-            return response.json()['session_token']
+            glpi.session_token = response.json()['session_token']
+            return glpi
         except json.JSONDecodeError as e:
             print(f"JSON Decode Error: {e}")
             print(f"Response content: {response.text}")
@@ -176,25 +1107,220 @@ def init_glpi_session():
         print(f"Response content: {response.text}")
         raise Exception("Failed to initialize GLPI session")
 
-def kill_glpi_session(session_token):
-    headers = {
-        "Content-Type": "application/json",
-        "Session-Token": session_token,
-        "App-Token": glpi_app_token
-    }
-    requests.get(f"{glpi_url}/killSession", headers=headers)
-
-def get_or_create_glpi_user(session_token, email, name=None):
-    headers = {
-        "Content-Type": "application/json",
-        "Session-Token": session_token,
-        "App-Token": glpi_app_token
-    }
-
+def kill_glpi_session(glpi):
+    glpi.get("/killSession")
+
+# GLPI ticket statuses are constants, not items that can be listed through the API
+glpi_ticket_statuses = {1: 'New', 2: 'Processing (assigned)', 3: 'Processing (planned)', 4: 'Pending', 5: 'Solved', 6: 'Closed'}
+
+def get_glpi_item_ids(glpi, itemtype, page_size=1000):
+    # Every id of an itemtype visible to the session, one page of page_size per request
+    ids = set()
+    start = 0
+    while True:
+        response = glpi.get(f"/{itemtype}", params={'range': f"{start}-{start + page_size - 1}", 'only_id': 'true'})
+        if response.status_code not in (200, 206):
+            raise Exception(f"Failed to list GLPI {itemtype}: {response.status_code} {response.text}")
+        rows = response.json()
+        ids.update(int(row['id']) for row in rows)
+        total = response.headers.get('Content-Range', '').rpartition('/')[2]
+        start += page_size
+        if len(rows) < page_size or (total.isdigit() and start >= int(total)):
+            return ids
+
+def osticket_mapping_usage(from_id=None, to_id=None):
+    # Number of tickets per department, status, assigned staff and help topic
+    cursor = get_osticket_db().cursor(dictionary=True)
+    where = "WHERE ticket_id >= %s AND ticket_id <= %s"
+    params = (from_id if from_id is not None else 0, to_id if to_id is not None else 2 ** 62)
+    usage = {}
+    for column in ('dept_id', 'status_id', 'staff_id', 'topic_id'):
+        query = f"SELECT {column} AS value, COUNT(*) AS tickets FROM ost_ticket {where} GROUP BY {column}"
+        usage[column] = {row['value']: row['tickets'] for row in
+                         timed_fetchall("mysql.osticket_mapping_usage", cursor, query, params)}
+    return usage
+
+def validate_mappings(glpi, from_id=None, to_id=None, check_osticket=True):
+    # Check the hand-written maps against GLPI (and the osTicket values they have to cover)
+    # before anything is written, so a bad configuration stops the run at once
+    problems = []
+    entities = get_glpi_item_ids(glpi, "Entity") | {0}
+    for dept_id, entity_id in department_to_entity_map.items():
+        if entity_id not in entities:
+            problems.append(f"department {dept_id} maps to GLPI entity {entity_id}, which does not exist")
+    for status_id, glpi_status in status_map.items():
+        if glpi_status not in glpi_ticket_statuses:
+            problems.append(f"status {status_id} maps to {glpi_status}, which is not a GLPI ticket status "
+                            f"({', '.join(f'{key} {name}' for key, name in glpi_ticket_statuses.items())})")
+    technicians = set(staff_to_technician_map.values()) - {0}
+    if technicians:
+        users = get_glpi_item_ids(glpi, "User")
+        for staff_id, user_id in staff_to_technician_map.items():
+            if user_id and user_id not in users:
+                problems.append(f"staff {staff_id} maps to GLPI user {user_id}, which does not exist")
+
+    if check_osticket:
+        usage = osticket_mapping_usage(from_id, to_id)
+        # Help topic ids are sent as they are as itilcategories_id
+        categories = get_glpi_item_ids(glpi, "ITILCategory") | {0}
+        for topic_id, tickets in sorted(usage['topic_id'].items()):
+            if topic_id not in categories:
+                problems.append(f"{tickets} tickets use help topic {topic_id}, which is not a GLPI ITILCategory id")
+        unmapped = [
+            (usage['dept_id'], department_to_entity_map, "department", "the root entity"),
+            (usage['status_id'], status_map, "status", "New"),
+            ({staff_id: tickets for staff_id, tickets in usage['staff_id'].items() if staff_id}, staff_to_technician_map,
+             "assigned staff", "no technician"),
+        ]
+        for values, mapping, label, fallback in unmapped:
+            for value, tickets in sorted(values.items()):
+                if value not in mapping:
+                    print(f"Warning: {tickets} tickets have unmapped {label} {value}, they will get {fallback}")
+        load_osticket_dimensions()
+        missing_staff = sorted(set(osticket_staff) - set(staff_to_technician_map))
+        if missing_staff:
+            print(f"Warning: staff {', '.join(map(str, missing_staff))} are not in staff_to_technician_map, "
+                  f"their replies will be posted without a GLPI user")
+
+    if problems:
+        raise Exception("Invalid mappings:\n  " + "\n  ".join(problems))
+
+# Cache of lowercased email -> GLPI user id, shared by all workers. A None value is a
+# negative result (the user could not be found nor created) and fails fast without API calls.
+glpi_user_cache = {}
+glpi_user_cache_lock = threading.Lock()
+glpi_user_cache_stats = {'hits': 0, 'misses': 0}
+# After a full prewarm every existing GLPI user is in the cache, so a miss means
+# the user has to be created and both searches can be skipped
+_glpi_user_cache_complete = False
+_glpi_user_cache_db = None
+_glpi_user_cache_db_lock = threading.Lock()
+_glpi_user_email_locks = {}
+
+def open_glpi_user_cache(path):
+    # Persist found and created users in a local SQLite file so resumed runs skip the lookups.
+    # Users GLPI refused are only kept in memory, so a fixed user is retried on the next run.
+    # Other processes may use the same file at the same time (shards, a sync next to the
+    # migration). No lock on it is held during GLPI calls, each write is a single INSERT, and
+    # the busy timeout is still well above the longest GLPI request with its retries.
+    global _glpi_user_cache_db
+    _glpi_user_cache_db = sqlite3.connect(path, timeout=600, check_same_thread=False)
+    _glpi_user_cache_db.execute("PRAGMA journal_mode=WAL")
+    _glpi_user_cache_db.execute(
+        "CREATE TABLE IF NOT EXISTS glpi_users (email TEXT PRIMARY KEY, glpi_user_id INTEGER NOT NULL)"
+    )
+    with glpi_user_cache_lock:
+        for email, user_id in _glpi_user_cache_db.execute("SELECT email, glpi_user_id FROM glpi_users"):
+            glpi_user_cache[email] = user_id
+    return len(glpi_user_cache)
+
+def close_glpi_user_cache():
+    global _glpi_user_cache_db
+    with _glpi_user_cache_db_lock:
+        if _glpi_user_cache_db is not None:
+            _glpi_user_cache_db.close()
+            _glpi_user_cache_db = None
+
+def cache_glpi_user(email, user_id):
+    key = email.strip().lower()
+    with glpi_user_cache_lock:
+        glpi_user_cache[key] = user_id
+    with _glpi_user_cache_db_lock:
+        if _glpi_user_cache_db is not None and user_id is not None:
+            _glpi_user_cache_db.execute(
+                "INSERT OR REPLACE INTO glpi_users (email, glpi_user_id) VALUES (?, ?)", (key, user_id)
+            )
+            _glpi_user_cache_db.commit()
+
+def read_cached_glpi_user(email):
+    # Other processes may share the user cache file (shards, a sync next to the migration),
+    # so a user missing from memory may have been found or created by one of them
+    with _glpi_user_cache_db_lock:
+        if _glpi_user_cache_db is None:
+            return None
+        row = _glpi_user_cache_db.execute("SELECT glpi_user_id FROM glpi_users WHERE email = ?",
+                                          (email.strip().lower(),)).fetchone()
+    return row[0] if row else None
+
+def prewarm_glpi_user_cache(glpi, page_size=1000):
+    # Load every GLPI user (login name and emails) with a paginated search, so that
+    # get_or_create_glpi_user only has to call the API for users that must be created
+    global _glpi_user_cache_complete
+    by_email = {}
+    by_login = {}
+    start = 0
+    while True:
+        search_params = {
+            'forcedisplay[0]': 1,  # login name
+            'forcedisplay[1]': 2,  # ID field
+            'forcedisplay[2]': 5,  # email field
+            'range': f"{start}-{start + page_size - 1}"
+        }
+        response = glpi.get("/search/User", params=search_params)
+        if response.status_code not in (200, 206):
+            print(f"Failed to prewarm user cache. Status code: {response.status_code}")
+            return 0
+        search_result = response.json()
+        rows = search_result.get('data', [])
+        for row in rows:
+            user_id = row.get("2")
+            # Users with several emails get them joined with GLPI's multi-value separator
+            for address in str(row.get("5") or "").split("$$##$$"):
+                if address.strip():
+                    by_email.setdefault(address.strip().lower(), user_id)
+            if row.get("1"):
+                by_login.setdefault(str(row["1"]).strip().lower(), user_id)
+        start += page_size
+        if not rows or start >= search_result.get('totalcount', 0):
+            break
+
+    # Same priority as the lookups: email field first, then the login name
+    for login, user_id in by_login.items():
+        by_email.setdefault(login, user_id)
+    with glpi_user_cache_lock:
+        for email, user_id in by_email.items():
+            glpi_user_cache.setdefault(email, user_id)
+        _glpi_user_cache_complete = True
+    return len(by_email)
+
+class GLPIUserRejected(Exception):
+    # GLPI answered the user creation with an error, asking again for that email won't help
+    pass
+
+def get_or_create_glpi_user(glpi, email, name=None):
     #print(email)
     if email == None:
         return 0
 
+    key = email.strip().lower()
+    with glpi_user_cache_lock:
+        email_lock = _glpi_user_email_locks.setdefault(key, threading.Lock())
+
+    # Only one worker resolves a given email at a time, so a user is never created twice
+    with email_lock:
+        with glpi_user_cache_lock:
+            if key in glpi_user_cache:
+                glpi_user_cache_stats['hits'] += 1
+                user_id = glpi_user_cache[key]
+                if user_id is None:
+                    raise Exception(f"Failed to create user: {email} (cached)")
+                return user_id
+            glpi_user_cache_stats['misses'] += 1
+            search = not _glpi_user_cache_complete
+
+        # Only a user GLPI refused is remembered as failed. Timeouts, connection errors and
+        # error pages are raised without caching, so the next ticket asks again.
+        try:
+            user_id = read_cached_glpi_user(email)
+            if user_id is None:
+                user_id = find_or_create_glpi_user(glpi, email, name, search)
+        except GLPIUserRejected:
+            cache_glpi_user(email, None)
+            raise
+        cache_glpi_user(email, user_id)
+        return user_id
+
+def search_glpi_user(glpi, email):
     # Search for existing user
     search_params = {
         'criteria[0][field]': 5, # this is email field
@@ -202,7 +1328,7 @@ def get_or_create_glpi_user(session_token, email, name=None):
         'criteria[0][value]': email,
         'forcedisplay[0]': 2  # ID field
     }
-    response = requests.get(f"{glpi_url}/search/User", headers=headers, params=search_params)
+    response = glpi.get("/search/User", params=search_params)
     search_result = response.json()
 
     if search_result['totalcount'] > 0:
@@ -214,11 +1340,18 @@ def get_or_create_glpi_user(session_token, email, name=None):
         'criteria[0][value]': email,
         'forcedisplay[0]': 2  # ID field
     }
-    response = requests.get(f"{glpi_url}/search/User", headers=headers, params=search_params)
+    response = glpi.get("/search/User", params=search_params)
     search_result = response.json()
 
     if search_result['totalcount'] > 0:
         return search_result['data'][0]["2"]  # Return the ID of the first matching user
+    return None
+
+def find_or_create_glpi_user(glpi, email, name=None, search=True):
+    if search:
+        user_id = search_glpi_user(glpi, email)
+        if user_id is not None:
+            return user_id
 
     # If user doesn't exist, create a new one
     payload = {
@@ -234,39 +1367,35 @@ def get_or_create_glpi_user(session_token, email, name=None):
             "entities_id": 0  # Assign to root entity
         }
     }
-    response = requests.post(f"{glpi_url}/User", headers=headers, json=payload)
+    response = glpi.post("/User", json=payload)
+    if response.status_code == 400:
+        # GLPI refuses a login that exists already: another process sharing this migration may
+        # have created the user since the search
+        user_id = search_glpi_user(glpi, email)
+        if user_id is not None:
+            return user_id
+        raise GLPIUserRejected(f"Failed to create user: {response.text}")
     new_user = response.json()
     if 'id' in new_user:
         return new_user['id']
     else:
         raise Exception(f"Failed to create user: {new_user}")
 
-def impersonate_user(session_token, user_id):
-    headers = {
-        "Content-Type": "application/json",
-        "Session-Token": session_token,
-        "App-Token": glpi_app_token
-    }
+def impersonate_user(glpi, user_id):
     data = {"users_id": user_id}
-    response = requests.post(f"{glpi_url}/changeActiveEntities/", headers=headers, json=data)
+    response = glpi.post("/changeActiveEntities/", json=data)
     if response.status_code != 200:
         raise Exception(f"Failed to impersonate user: {response.text}")
 
-def create_glpi_ticket(session_token, ticket_data, attachments=None):
-    headers = {
-        "Content-Type": "application/json",
-        "Session-Token": session_token,
-        "App-Token": glpi_app_token
-    }
-
+def create_glpi_ticket(glpi, ticket_data, attachments=None):
     # I want to identificate specific user with specific id cause user find not work very well, else find correct one
     if ticket_data['requester_email'] == "no_reply@example.com":
         requester_id = 999999
     else:
-        requester_id = get_or_create_glpi_user(session_token, ticket_data['requester_email'], ticket_data['requester_name'])
+        requester_id = get_or_create_glpi_user(glpi, ticket_data['requester_email'], ticket_data['requester_name'])
 
     # Impersonate the requester
-    impersonate_user(session_token, requester_id)
+    impersonate_user(glpi, requester_id)
 
     # Map OsTicket department ID to GLPI entity ID
     entity_id = department_to_entity_map.get(ticket_data['dept_id'], 0)  # Default to root entity (0) if not found
@@ -306,226 +1435,1224 @@ def create_glpi_ticket(session_token, ticket_data, attachments=None):
     if ticket_data['closed']:
         payload['input']["closedate"] = str(ticket_data['closed'])
 
-    response = requests.post(f"{glpi_url}/Ticket", headers=headers, json=payload)
+    response = glpi.post("/Ticket", json=payload)
     #print(response.text)
     #print(response)
     return response.json()
 
-def add_watcher_to_glpi_ticket(session_token, ticket_id, watcher_email, watcher_name):
-    headers = {
-        "Content-Type": "application/json",
-        "Session-Token": session_token,
-        "App-Token": glpi_app_token
-    }
-
-    watcher_id = get_or_create_glpi_user(session_token, watcher_email, watcher_name)
-
-    payload = {
-        "input": {
-            "tickets_id": ticket_id,
-            "users_id": watcher_id,
-            "type": 3  # 3 is the type for watchers in GLPI
-        }
+def watcher_input(glpi, ticket_id, watcher_email, watcher_name):
+    watcher_id = get_or_create_glpi_user(glpi, watcher_email, watcher_name)
+    return {
+        "tickets_id": ticket_id,
+        "users_id": watcher_id,
+        "type": 3  # 3 is the type for watchers in GLPI
     }
 
-    response = requests.post(f"{glpi_url}/Ticket_User", headers=headers, json=payload)
-    return response.json()
-
-def add_followup_to_glpi_ticket(session_token, ticket_id, followup_data, attachments=None):
-    headers = {
-        "Content-Type": "application/json",
-        "Session-Token": session_token,
-        "App-Token": glpi_app_token
+def entry_user_id(glpi, entry):
+    # GLPI user for a thread entry: the mapped technician for staff, the requester for users
+    if entry['staff_id'] != 0:
+        return staff_to_technician_map.get(entry['staff_id'], 0)
+    elif entry['user_id'] != 0:
+        return get_or_create_glpi_user(glpi, entry['user_email'], entry['user_name'])
+    else:
+        return 0  # Default to 0 if no user or staff is associated
+
+def followup_input(glpi, ticket_id, followup_data):
+    return {
+        "items_id": ticket_id,
+        "itemtype": "Ticket",
+        "content": followup_data['body'],
+        "date_creation": str(followup_data['created']),
+        "users_id": entry_user_id(glpi, followup_data),
+        "is_private": 0 if followup_data['type'] == 'M' else 1,  # Assuming 'M' is for public messages not works very well
     }
 
-    if followup_data['staff_id'] != 0:
-        user_id = staff_to_technician_map.get(followup_data['staff_id'], 0)
-    elif followup_data['user_id'] != 0:
-        user_id = get_or_create_glpi_user(session_token, followup_data['user_email'], followup_data['user_name'])
-    else:
-        user_id = 0  # Default to 0 if no user or staff is associated
+def changed_since(value, since):
+    # osTicket dates as datetime (MySQL) or text, zero dates come back as None
+    return value is not None and str(value) >= since
 
+def update_glpi_ticket(glpi, glpi_ticket_id, ticket_data, content_changed=False):
+    # Push the fields a ticket can change after it was migrated
     payload = {
         "input": {
-            "items_id": ticket_id,
-            "itemtype": "Ticket",
-            "content": followup_data['body'],
-            "date_creation": str(followup_data['created']),
-            "users_id": user_id,
-            "is_private": 0 if followup_data['type'] == 'M' else 1,  # Assuming 'M' is for public messages not works very well
+            "name": ticket_data['subject'],
+            "status": status_map.get(ticket_data['status_id'], 1),
+            "priority": ticket_data['priority'],
+            "date_mod": str(ticket_data['lastupdate']),
         }
     }
-    
-    response = requests.post(f"{glpi_url}/ITILFollowup", headers=headers, json=payload)
-    return response.json()
+    if ticket_data['closed']:
+        payload['input']["closedate"] = str(ticket_data['closed'])
+    if content_changed:
+        payload['input']["content"] = ticket_data.get('ticket_body', 'No ticket content')
+    response = glpi.put(f"/Ticket/{glpi_ticket_id}", json=payload)
+    if response.status_code != 200:
+        print(f"Failed to update ticket {glpi_ticket_id}. Status code: {response.status_code}")
+        return False
+    return True
 
-def add_document_to_glpi_ticket(session_token, ticket_id, document_data, file_content, followup_data, entity_id=0):
-    headers = {
-        "Session-Token": session_token,
-        "App-Token": glpi_app_token
+def update_glpi_followup(glpi, followup_id, followup_data):
+    payload = {"input": {"content": followup_data['body']}}
+    response = glpi.put(f"/ITILFollowup/{followup_id}", json=payload)
+    if response.status_code != 200:
+        print(f"Failed to update followup {followup_id}. Status code: {response.status_code}")
+        return False
+    return True
+
+def document_link_input(ticket_id, document_data, document_id, user_id):
+    return {
+        'itemtype': 'Ticket',
+        'items_id': ticket_id,
+        "users_id": user_id,
+        'date_creation': str(document_data['created_date']),
+        'documents_id': document_id
     }
 
-    #if file_content is None:
-    #    print(f"Skipping attachment {document_data['attachment_name']} due to missing file content")
-    #    return None
-
-    if followup_data['staff_id'] != 0:
-        user_id = staff_to_technician_map.get(followup_data['staff_id'], 0)
-    elif followup_data['user_id'] != 0:
-        user_id = get_or_create_glpi_user(session_token, followup_data['user_email'], followup_data['user_name'])
-    else:
-        user_id = 0  # Default to 0 if no user or staff is associated
+def post_glpi_items(glpi, itemtype, inputs, size=None):
+    # Create items of one itemtype with up to bulk_write_size inputs per POST. GLPI answers a
+    # list input with one {"id": ..., "message": ...} per item, in order, and id false for the
+    # items it rejected; with 207 (some failed) or 400 (all failed) that list comes wrapped as
+    # [error code, [items]]. Returns the new ids in the order of inputs, None for the items
+    # that were not created.
+    size = max(1, size or bulk_write_size)
+    ids = []
+    for start in range(0, len(inputs), size):
+        chunk = inputs[start:start + size]
+        response = glpi.post(f"/{itemtype}", json={"input": chunk if len(chunk) > 1 else chunk[0]})
+        try:
+            result = response.json()
+        except ValueError:
+            result = None
+        if len(chunk) == 1 and isinstance(result, dict):
+            result = [result]
+        if (isinstance(result, list) and len(result) == 2 and isinstance(result[0], str)
+                and isinstance(result[1], list)):
+            result = result[1]
+        items = None
+        if isinstance(result, list) and len(result) == len(chunk) and all(isinstance(item, dict) for item in result):
+            items = result
+        created_nothing = response.status_code == 400 and (items is None or not any(item.get('id') for item in items))
+        if len(chunk) > 1 and created_nothing:
+            # GLPI refused the whole request (e.g. one invalid input fails the lot on some GLPI
+            # versions) and created nothing, so one POST per item finds out which ones are fine
+            print(f"Bulk {itemtype} creation failed with status {response.status_code}, retrying one by one")
+            for item in chunk:
+                ids.extend(post_glpi_items(glpi, itemtype, [item], 1))
+        elif items is not None and response.status_code in (200, 201, 207, 400):
+            for item in items:
+                if not item.get('id'):
+                    print(f"Failed to create {itemtype}: {item.get('message')}")
+                ids.append(item.get('id') or None)
+        else:
+            # Any other answer (a 5xx, a proxy error page) does not say what GLPI created, so
+            # nothing is sent again here and the items are left for --resume
+            print(f"Failed to create {len(chunk)} {itemtype}: {response.status_code} {response.text[:200]}")
+            ids.extend([None] * len(chunk))
+    return ids
+
+# Documents already uploaded in this run or a previous one, keyed on (dedup key, entity id)
+uploaded_documents = {}
+_uploaded_documents_lock = threading.Lock()
+_uploaded_document_key_locks = {}
+
+def document_dedup_key(document_data, file_content):
+    # osTicket stores a content hash in ost_file.signature; fall back to hashing the content
+    # when it was read into memory. Streamed files without a signature are not deduplicated.
+    if document_data.get('signature'):
+        return f"signature:{document_data['signature']}:{document_data.get('size')}"
+    if isinstance(file_content, bytes):
+        return f"sha256:{hashlib.sha256(file_content).hexdigest()}"
+    return None
+
+def uploaded_document_lock(dedup_key, entity_id):
+    # Serializes uploads of the same file, so concurrent workers upload it only once
+    if dedup_key is None:
+        return contextlib.nullcontext()
+    with _uploaded_documents_lock:
+        return _uploaded_document_key_locks.setdefault((dedup_key, entity_id), threading.Lock())
+
+def get_uploaded_document(dedup_key, entity_id):
+    with _uploaded_documents_lock:
+        document_id = uploaded_documents.get((dedup_key, entity_id))
+    if document_id is None:
+        document_id = get_mapped_uploaded_file(dedup_key, entity_id)
+        if document_id is not None:
+            with _uploaded_documents_lock:
+                uploaded_documents[(dedup_key, entity_id)] = document_id
+    return document_id
+
+def already_uploaded(document_data, entity_id):
+    # Files whose osTicket signature is already in GLPI only need a link, their content is not read
+    dedup_key = document_dedup_key(document_data, None) if deduplicate_attachments else None
+    return dedup_key is not None and get_uploaded_document(dedup_key, entity_id) is not None
+
+def record_uploaded_document(dedup_key, entity_id, document_id):
+    with _uploaded_documents_lock:
+        uploaded_documents[(dedup_key, entity_id)] = document_id
+    record_uploaded_file(dedup_key, entity_id, document_id)
+
+def upload_ticket_document(glpi, ticket_id, document_data, file_content, followup_data, entity_id=0):
+    # Upload a document (or reuse the deduplicated copy) without linking it yet. Returns the
+    # Document_Item input that links it to the ticket and whether the document has to be
+    # deleted when that link fails, or None if the upload failed.
+    user_id = entry_user_id(glpi, followup_data)
+
+    dedup_key = document_dedup_key(document_data, file_content) if deduplicate_attachments else None
+    with uploaded_document_lock(dedup_key, entity_id):
+        document_id = get_uploaded_document(dedup_key, entity_id) if dedup_key else None
+        orphan = False
+        if document_id is None:
+            document_id = upload_glpi_document(glpi, ticket_id, document_data, file_content, user_id, entity_id)
+            if document_id is None:
+                return None
+            if dedup_key:
+                # Recorded before it is linked so other workers reuse it; if the link fails the
+                # document is kept and linked by the next run instead of being uploaded again
+                record_uploaded_document(dedup_key, entity_id, document_id)
+            else:
+                orphan = True
+    return document_link_input(ticket_id, document_data, document_id, user_id), orphan
 
+def upload_glpi_document(glpi, ticket_id, document_data, file_content, user_id, entity_id=0):
     file_name = document_data['attachment_name'] or document_data['file_name']
     file_mime = mimetypes.guess_type(file_name)[0] or 'application/octet-stream'
 
-    files = {
-        'uploadManifest': (None, json.dumps({
-            'input': {
-                'name': file_name,
-                "entities_id": entity_id,
-                "users_id": user_id,
-                'date_creation': str(document_data['created_date']),
-                '_filename': [file_name]
-            }
-        }), 'application/json'),
-        'filename[0]': (file_name, file_content, file_mime)
-    }
-
-    response = requests.post(f"{glpi_url}/Document", headers=headers, files=files)
-
-    if response.status_code == 201:
-        document_id = response.json()['id']
-
-        # Link the document to the ticket
-        link_payload = {
-            'input': {
-                'itemtype': 'Ticket',
-                'items_id': ticket_id,
-                "users_id": user_id,
-                'date_creation': str(document_data['created_date']),
-                'documents_id': document_id
-            }
+    upload_manifest = json.dumps({
+        'input': {
+            'name': file_name,
+            "entities_id": entity_id,
+            "users_id": user_id,
+            'date_creation': str(document_data['created_date']),
+            '_filename': [file_name]
         }
-        link_response = requests.post(f"{glpi_url}/Document_Item", headers=headers, json=link_payload)
-
-        if link_response.status_code == 201:
-            #print(f"Document {document_id} linked to ticket {ticket_id}")
-            return document_id
-        else:
-            print(f"Failed to link document {document_id} to ticket {ticket_id}")
-            print(f"Status code: {link_response.status_code}")
-            #print(f"Response content: {link_response.text}")
+    })
 
-            # If linking fails, we should delete the uploaded document to avoid orphaned documents
-            delete_response = requests.delete(f"{glpi_url}/Document/{document_id}", headers=headers)
-            # if delete_response.status_code == 200:
-                # print(f"Deleted orphaned document {document_id}")
-            # else:
-                # print(f"Failed to delete orphaned document {document_id}")
+    if isinstance(file_content, FileStream):
+        body = MultipartStream({'uploadManifest': upload_manifest}, [('filename[0]', file_name, file_mime, file_content)])
+        response = glpi.post("/Document", headers={"Content-Type": body.content_type}, data=body)
+    else:
+        files = {
+            'uploadManifest': (None, upload_manifest, 'application/json'),
+            'filename[0]': (file_name, file_content, file_mime)
+        }
+        response = glpi.post("/Document", files=files)
 
-            return None
+    if response.status_code == 201:
+        return response.json()['id']
     else:
         print(f"Failed to upload document for ticket {ticket_id}")
         print(f"Status code: {response.status_code}")
         #print(f"Response content: {response.text}")
         return None
 
-def associate_attachments_with_followup(session_token, followup_id, attachments):
-    headers = {
-        "Session-Token": session_token,
-        "App-Token": glpi_app_token
-    }
-
-    for attachment in attachments:
-        file_content = get_file_content(attachment['file_id'])
-        file_name = attachment['attachment_name'] or attachment['file_name']
-        file_mime = mimetypes.guess_type(file_name)[0] or 'application/octet-stream'
-
-        files = {
-            'uploadManifest': (None, json.dumps({
-                'input': {
-                    'name': file_name,
-                    '_filename': [file_name]
-                }
-            }), 'application/json'),
-            'filename[0]': (file_name, file_content, file_mime)
-        }
-
-        response = requests.post(f"{glpi_url}/Document", headers=headers, files=files)
-
-        if response.status_code == 201:
-            document_id = response.json()['id']
+def get_followup_document_ids(glpi, followup_id):
+    # Documents created from the files of an inline followup, in upload order: GLPI links them
+    # in the order of _filename, so the link ids follow the files even when it reused a document
+    response = glpi.get(f"/ITILFollowup/{followup_id}/Document_Item", params={'range': '0-999'})
+    if response.status_code not in (200, 206):
+        return None
+    links = sorted(response.json(), key=lambda link: int(link['id']))
+    return [int(link['documents_id']) for link in links]
+
+def add_followup_with_attachments(glpi, ticket_id, followup_data, attachments):
+    # Create the followup and its documents in one multipart request: GLPI stores the uploaded
+    # files (_filename/_prefix_filename) as documents linked to the ticket and the followup.
+    # attachments is a list of (attachment, file content) pairs. Returns the followup id.
+    file_names = [attachment['attachment_name'] or attachment['file_name'] for attachment, _ in attachments]
+    upload_manifest = json.dumps({
+        'input': dict(followup_input(glpi, ticket_id, followup_data), _filename=file_names)
+    })
+    files = [
+        (f"filename[{index}]", file_name, mimetypes.guess_type(file_name)[0] or 'application/octet-stream', file_content)
+        for index, (file_name, (_, file_content)) in enumerate(zip(file_names, attachments))
+    ]
+    body = MultipartStream({'uploadManifest': upload_manifest}, files)
+    response = glpi.post("/ITILFollowup", headers={"Content-Type": body.content_type}, data=body)
 
-            # Link the document to the followup
-            link_payload = {
-                'input': {
-                    'itemtype': 'ITILFollowup',
-                    'items_id': followup_id,
-                    'documents_id': document_id
-                }
-            }
-            link_response = requests.post(f"{glpi_url}/Document_Item", headers=headers, json=link_payload)
+    if response.status_code == 201:
+        return response.json()['id']
+    else:
+        print(f"Failed to add followup with {len(files)} attachment(s) to ticket {ticket_id}")
+        print(f"Status code: {response.status_code}")
+        return None
 
-            if link_response.status_code == 201:
-                print(f"Document {document_id} linked to followup {followup_id}")
-            else:
-                print(f"Failed to link document {document_id} to followup {followup_id}")
+# Local durable mapping of osTicket ids to the GLPI ids created for them, written as each
+# item is created, so an interrupted run can be resumed without duplicating anything
+_mapping_db = None
+_mapping_lock = threading.Lock()
+
+def open_mapping_store(path, in_memory=False):
+    global _mapping_db
+    if in_memory:
+        # A copy of the state for --dry-run, which must not record anything in the file
+        _mapping_db = sqlite3.connect(":memory:", check_same_thread=False)
+        if os.path.exists(path):
+            source = sqlite3.connect(path, timeout=60)
+            try:
+                source.backup(_mapping_db)
+            finally:
+                source.close()
+    else:
+        _mapping_db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+    _mapping_db.execute("PRAGMA journal_mode=WAL")
+    _mapping_db.execute("PRAGMA synchronous=NORMAL")
+    _mapping_db.executescript("""
+    CREATE TABLE IF NOT EXISTS tickets (
+        ticket_id INTEGER PRIMARY KEY,
+        glpi_ticket_id INTEGER NOT NULL,
+        completed INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE TABLE IF NOT EXISTS watchers (
+        ticket_id INTEGER NOT NULL,
+        email TEXT NOT NULL,
+        glpi_ticket_user_id INTEGER,
+        PRIMARY KEY (ticket_id, email)
+    );
+    CREATE TABLE IF NOT EXISTS followups (
+        entry_id INTEGER PRIMARY KEY,
+        ticket_id INTEGER NOT NULL,
+        glpi_followup_id INTEGER NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS documents (
+        attachment_id INTEGER PRIMARY KEY,
+        entry_id INTEGER NOT NULL,
+        ticket_id INTEGER NOT NULL,
+        glpi_document_id INTEGER NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS followups_ticket ON followups (ticket_id);
+    CREATE TABLE IF NOT EXISTS uploaded_files (
+        file_key TEXT NOT NULL,
+        entity_id INTEGER NOT NULL,
+        glpi_document_id INTEGER NOT NULL,
+        PRIMARY KEY (file_key, entity_id)
+    );
+    CREATE INDEX IF NOT EXISTS documents_ticket ON documents (ticket_id);
+    CREATE TABLE IF NOT EXISTS sync_state (
+        name TEXT PRIMARY KEY,
+        value TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS ticket_claims (
+        ticket_id INTEGER PRIMARY KEY,
+        pid INTEGER NOT NULL
+    );
+    """)
+    with _mapping_lock:
+        return _mapping_db.execute("SELECT COUNT(*) FROM tickets").fetchone()[0]
+
+def close_mapping_store():
+    global _mapping_db
+    if _mapping_db is not None:
+        _mapping_db.close()
+        _mapping_db = None
+
+def _mapping_query(query, params=()):
+    if _mapping_db is None:
+        return []
+    with _mapping_lock:
+        return _mapping_db.execute(query, params).fetchall()
+
+def _mapping_write(query, params=()):
+    if _mapping_db is None:
+        return
+    with _mapping_lock:
+        _mapping_db.execute(query, params)
+        _mapping_db.commit()
+
+def get_mapped_ticket(ticket_id):
+    # Returns (glpi_ticket_id, completed) or None if the ticket was never created in GLPI
+    rows = _mapping_query("SELECT glpi_ticket_id, completed FROM tickets WHERE ticket_id = ?", (ticket_id,))
+    return (rows[0][0], bool(rows[0][1])) if rows else None
+
+def is_ticket_completed(ticket_id):
+    mapping = get_mapped_ticket(ticket_id)
+    return mapping is not None and mapping[1]
+
+def record_ticket(ticket_id, glpi_ticket_id, completed=False):
+    _mapping_write("INSERT OR REPLACE INTO tickets (ticket_id, glpi_ticket_id, completed) VALUES (?, ?, ?)",
+                   (ticket_id, glpi_ticket_id, int(completed)))
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def claim_ticket(ticket_id):
+    # Processes sharing the state file (a sync running next to the migration) must never work
+    # on the same ticket at once, or both would create it. The claim is taken in one write
+    # transaction and fails while another live process holds it; a claim left behind by a
+    # process that died is taken over.
+    if _mapping_db is None:
+        return True
+    with _mapping_lock:
+        _mapping_db.execute("BEGIN IMMEDIATE")
+        try:
+            row = _mapping_db.execute("SELECT pid FROM ticket_claims WHERE ticket_id = ?", (ticket_id,)).fetchone()
+            if row and row[0] != os.getpid() and process_alive(row[0]):
+                _mapping_db.rollback()
+                return False
+            _mapping_db.execute("INSERT OR REPLACE INTO ticket_claims (ticket_id, pid) VALUES (?, ?)",
+                                (ticket_id, os.getpid()))
+            _mapping_db.commit()
+        except Exception:
+            _mapping_db.rollback()
+            raise
+    return True
+
+def release_ticket(ticket_id):
+    _mapping_write("DELETE FROM ticket_claims WHERE ticket_id = ? AND pid = ?", (ticket_id, os.getpid()))
+
+def get_sync_mark():
+    rows = _mapping_query("SELECT value FROM sync_state WHERE name = 'high_water_mark'")
+    return rows[0][0] if rows else None
+
+def record_sync_mark(mark, replace=True):
+    # The first migration run sets the mark once, every successful sync moves it forward
+    verb = "INSERT OR REPLACE" if replace else "INSERT OR IGNORE"
+    _mapping_write(f"{verb} INTO sync_state (name, value) VALUES ('high_water_mark', ?)", (mark,))
+
+def get_mapped_watchers(ticket_id):
+    return {row[0] for row in _mapping_query("SELECT email FROM watchers WHERE ticket_id = ?", (ticket_id,))}
+
+def record_watcher(ticket_id, email, glpi_ticket_user_id):
+    _mapping_write("INSERT OR REPLACE INTO watchers (ticket_id, email, glpi_ticket_user_id) VALUES (?, ?, ?)",
+                   (ticket_id, email, glpi_ticket_user_id))
+
+def get_mapped_followups(ticket_id):
+    return dict(_mapping_query("SELECT entry_id, glpi_followup_id FROM followups WHERE ticket_id = ?", (ticket_id,)))
+
+def record_followup(entry_id, ticket_id, glpi_followup_id):
+    _mapping_write("INSERT OR REPLACE INTO followups (entry_id, ticket_id, glpi_followup_id) VALUES (?, ?, ?)",
+                   (entry_id, ticket_id, glpi_followup_id))
+
+def get_mapped_documents(ticket_id):
+    return dict(_mapping_query("SELECT attachment_id, glpi_document_id FROM documents WHERE ticket_id = ?", (ticket_id,)))
+
+def record_document(attachment_id, entry_id, ticket_id, glpi_document_id):
+    _mapping_write("INSERT OR REPLACE INTO documents (attachment_id, entry_id, ticket_id, glpi_document_id) VALUES (?, ?, ?, ?)",
+                   (attachment_id, entry_id, ticket_id, glpi_document_id))
+
+def get_mapped_uploaded_file(file_key, entity_id):
+    rows = _mapping_query("SELECT glpi_document_id FROM uploaded_files WHERE file_key = ? AND entity_id = ?",
+                          (file_key, entity_id))
+    return rows[0][0] if rows else None
+
+def record_uploaded_file(file_key, entity_id, glpi_document_id):
+    _mapping_write("INSERT OR REPLACE INTO uploaded_files (file_key, entity_id, glpi_document_id) VALUES (?, ?, ?)",
+                   (file_key, entity_id, glpi_document_id))
+
+def migrate_attachments(glpi, ticket, glpi_ticket_id, thread, thread_attachments, done_documents, entity_id, links,
+                        contents=None):
+    # Uploads the entry's attachments and queues their Document_Item links in links,
+    # link_ticket_documents creates them afterwards in bulk
+    ok = True
+    for attachment in thread_attachments:
+        if attachment['id'] in done_documents:
+            continue
+        file_content = None if already_uploaded(attachment, entity_id) else load_attachment_content(attachment, contents)
+        uploaded = upload_ticket_document(glpi, glpi_ticket_id, attachment, file_content, thread, entity_id)
+        if uploaded is None:
+            print(f"Failed to add attachment {attachment['attachment_name']} to ticket {glpi_ticket_id}")
+            ok = False
         else:
-            print(f"Failed to upload document for followup {followup_id}")
-
-def main():
-    session_token = init_glpi_session()
+            link, orphan = uploaded
+            links.append((attachment, thread, link, orphan))
+    return ok
+
+def migrate_followup_inline(glpi, ticket, glpi_ticket_id, thread, thread_attachments,
+                            done_followups, done_documents, entity_id, contents=None):
+    # Creates the followup together with its attachments. Returns False when there is nothing
+    # to send inline or the upload failed, the followup then goes through the bulk path and
+    # its attachments through Document + Document_Item.
+    inline = []
+    for attachment in thread_attachments:
+        if attachment['id'] in done_documents:
+            continue
+        # Files already in GLPI only need a link
+        if already_uploaded(attachment, entity_id):
+            continue
+        file_content = load_attachment_content(attachment, contents)
+        if file_content is not None:
+            inline.append((attachment, file_content))
+    if not inline:
+        return False
+
+    followup_id = add_followup_with_attachments(glpi, glpi_ticket_id, thread, inline)
+    if followup_id is None:
+        return False
+    record_followup(thread['id'], ticket['ticket_id'], followup_id)
+    done_followups[thread['id']] = followup_id
+    # GLPI only answers with the followup id, the documents are read from its links.
+    # 0 marks documents whose id could not be read.
+    document_ids = get_followup_document_ids(glpi, followup_id)
+    if document_ids is None or len(document_ids) != len(inline):
+        print(f"Could not read the documents of followup {followup_id}, recorded without their ids")
+        document_ids = [0] * len(inline)
+    for (attachment, file_content), document_id in zip(inline, document_ids):
+        record_document(attachment['id'], thread['id'], ticket['ticket_id'], document_id)
+        done_documents[attachment['id']] = document_id
+        dedup_key = document_dedup_key(attachment, file_content) if deduplicate_attachments else None
+        if document_id and dedup_key:
+            record_uploaded_document(dedup_key, entity_id, document_id)
+    return True
+
+def post_followups(glpi, ticket, glpi_ticket_id, threads, done_followups):
+    # Create the followups of these thread entries, bulk_write_size of them per POST
+    ok = True
+    followup_ids = post_glpi_items(glpi, "ITILFollowup", [
+        followup_input(glpi, glpi_ticket_id, thread) for thread in threads
+    ])
+    for thread, followup_id in zip(threads, followup_ids):
+        if followup_id:
+            record_followup(thread['id'], ticket['ticket_id'], followup_id)
+            done_followups[thread['id']] = followup_id
+        else:
+            print(f"Failed to add followup to ticket {glpi_ticket_id}")
+            ok = False
+    return ok
+
+def link_ticket_documents(glpi, ticket, glpi_ticket_id, links, done_documents):
+    # A file attached to several entries of the same ticket is deduplicated to one document,
+    # which is linked to the ticket only once
+    linked = set(done_documents.values())
+    pending = {}
+    for attachment, thread, link, orphan in links:
+        if link['documents_id'] not in linked:
+            pending.setdefault(link['documents_id'], (link, orphan))
+    link_ids = post_glpi_items(glpi, "Document_Item", [link for link, _ in pending.values()])
+    for (document_id, (link, orphan)), link_id in zip(list(pending.items()), link_ids):
+        if link_id:
+            linked.add(document_id)
+        else:
+            print(f"Failed to link document {document_id} to ticket {glpi_ticket_id}")
+            if orphan:
+                # Not shared with other tickets, so do not leave it orphaned in GLPI
+                glpi.delete(f"/Document/{document_id}")
+
+    ok = True
+    for attachment, thread, link, orphan in links:
+        if link['documents_id'] in linked:
+            record_document(attachment['id'], thread['id'], ticket['ticket_id'], link['documents_id'])
+        else:
+            ok = False
+    return ok
+
+def migrate_ticket(glpi, ticket, batch=None, since=None):
+    # Returns True once every part of the ticket is in GLPI. Anything already recorded in
+    # the mapping store (from an interrupted run) is skipped, so calling this again for a
+    # partly migrated ticket only creates what is missing. With since (a delta sync) a
+    # migrated ticket also gets its new parts and the changes made after that date.
+    mapping = get_mapped_ticket(ticket['ticket_id'])
+    if mapping is not None and mapping[1] and since is None:
+        return True
+    if not claim_ticket(ticket['ticket_id']):
+        print(f"Ticket {ticket['ticket_id']} is being migrated by another process, left for the next run")
+        return False
     try:
-        osticket_data = get_osticket_tickets()
-
-        for ticket in osticket_data:
-            # Create the main ticket in GLPI
-            glpi_ticket = create_glpi_ticket(session_token, ticket, [])
-
+        # Read again under the claim, the other process may have finished it in the meantime
+        mapping = get_mapped_ticket(ticket['ticket_id'])
+        if mapping is not None and mapping[1] and since is None:
+            return True
+        return migrate_claimed_ticket(glpi, ticket, mapping, batch, since)
+    finally:
+        release_ticket(ticket['ticket_id'])
+
+def migrate_claimed_ticket(glpi, ticket, mapping, batch=None, since=None):
+    threads = get_ticket_threads(ticket['ticket_id'], batch)
+    ticket = ticket_with_body(ticket, threads)
+    attachments = {thread['id']: get_osticket_attachments(thread['id'], batch) for thread in threads}
+    done_documents = get_mapped_documents(ticket['ticket_id'])
+    # Start reading the attachments while the ticket, watchers and followups are created
+    contents = None
+    if attachment_prefetcher is not None:
+        entity_id = department_to_entity_map.get(ticket['dept_id'], 0)
+        contents = attachment_prefetcher.prefetch([
+            attachment for thread in threads for attachment in attachments[thread['id']]
+            if attachment['id'] not in done_documents and not already_uploaded(attachment, entity_id)
+        ])
+    try:
+        return migrate_ticket_parts(glpi, ticket, mapping, threads, attachments, done_documents, contents, batch, since)
+    finally:
+        if contents is not None:
+            contents.close()
 
-            if 'id' not in glpi_ticket:
-                print(f"Failed to create ticket: {glpi_ticket}")
+def migrate_ticket_parts(glpi, ticket, mapping, threads, attachments, done_documents, contents=None, batch=None,
+                         since=None):
+    if mapping is not None:
+        glpi_ticket_id = mapping[0]
+    else:
+        # Create the main ticket in GLPI
+        glpi_ticket = create_glpi_ticket(glpi, ticket, [])
+
+        if 'id' not in glpi_ticket:
+            print(f"Failed to create ticket: {glpi_ticket}")
+            return False
+        glpi_ticket_id = glpi_ticket['id']
+        record_ticket(ticket['ticket_id'], glpi_ticket_id)
+
+    ok = True
+
+    # Add collaborators as watchers, bulk_write_size of them per POST
+    collaborators = get_ticket_collaborators(ticket['ticket_id'], batch)
+    done_watchers = get_mapped_watchers(ticket['ticket_id'])
+    new_watchers = [collaborator for collaborator in collaborators if collaborator['email'] not in done_watchers]
+    watcher_ids = post_glpi_items(glpi, "Ticket_User", [
+        watcher_input(glpi, glpi_ticket_id, collaborator['email'], collaborator['name']) for collaborator in new_watchers
+    ])
+    for collaborator, watcher_id in zip(new_watchers, watcher_ids):
+        if watcher_id:
+            record_watcher(ticket['ticket_id'], collaborator['email'], watcher_id)
+        else:
+            print(f"Failed to add watcher {collaborator['email']} to ticket {glpi_ticket_id}")
+            ok = False
+
+    # Add followups the same way. The first entry is the ticket content itself, only its
+    # attachments are added.
+    entity_id = department_to_entity_map.get(ticket['dept_id'], 0)
+    done_followups = get_mapped_followups(ticket['ticket_id'])
+    if since is not None and mapping is not None:
+        # Delta sync: bring the GLPI ticket and the followups edited in osTicket up to date
+        if changed_since(ticket['lastupdate'], since) or (threads and changed_since(threads[0]['updated'], since)):
+            content_changed = bool(threads) and changed_since(threads[0]['updated'], since)
+            ok = update_glpi_ticket(glpi, mapping[0], ticket, content_changed) and ok
+        for thread in threads[1:]:
+            if thread['id'] in done_followups and changed_since(thread['updated'], since):
+                ok = update_glpi_followup(glpi, done_followups[thread['id']], thread) and ok
+    # GLPI lists followups in the order they are created, so the pending bulk is sent before
+    # each followup that may go inline with its attachments
+    pending = []
+    for thread in threads[1:]:
+        if thread['id'] in done_followups:
+            continue
+        if inline_attachments and any(attachment['id'] not in done_documents for attachment in attachments[thread['id']]):
+            ok = post_followups(glpi, ticket, glpi_ticket_id, pending, done_followups) and ok
+            pending = []
+            if migrate_followup_inline(glpi, ticket, glpi_ticket_id, thread, attachments[thread['id']],
+                                       done_followups, done_documents, entity_id, contents):
                 continue
-
-            # Get and add collaborators as watchers
-            collaborators = get_ticket_collaborators(ticket['ticket_id'])
-            for collaborator in collaborators:
-                add_watcher_to_glpi_ticket(session_token, glpi_ticket['id'], collaborator['email'], collaborator['name'])
-
-            # Add followups
-            threads = get_ticket_threads(ticket['ticket_id'])
-            entity_id = department_to_entity_map.get(ticket['dept_id'], 0)
-            first = True
-            for thread in threads:
-                if not first:
-                    thread_attachments = get_osticket_attachments(thread['id'])
-                    followup = add_followup_to_glpi_ticket(session_token, glpi_ticket['id'], thread, thread_attachments)
-                    if followup and 'id' in followup:
-                        #print(f"Successfully added followup with ID {followup['id']} to ticket {glpi_ticket['id']}")
+        pending.append(thread)
+    ok = post_followups(glpi, ticket, glpi_ticket_id, pending, done_followups) and ok
+
+    # Upload the attachments, then link them all to the ticket. Attachments of an entry
+    # whose followup could not be created are left for the next run.
+    links = []
+    for index, thread in enumerate(threads):
+        if index > 0 and thread['id'] not in done_followups:
+            continue
+        ok = migrate_attachments(glpi, ticket, glpi_ticket_id, thread, attachments[thread['id']],
+                                 done_documents, entity_id, links, contents) and ok
+    ok = link_ticket_documents(glpi, ticket, glpi_ticket_id, links, done_documents) and ok
+
+    if ok:
+        record_ticket(ticket['ticket_id'], glpi_ticket_id, completed=True)
+    return ok
+
+def migration_worker(ticket_queue, results, results_lock, http=None, scheduler=None, since=None):
+    # Each worker owns its GLPI session and (through get_osticket_db) its MySQL connection,
+    # so every step of a ticket runs in order inside the same worker
+    glpi = init_glpi_session(http, scheduler)
+    try:
+        while True:
+            item = ticket_queue.get()
+            if item is None:
+                break
+            ticket, batch = item
+            try:
+                migrated = migrate_ticket(glpi, ticket, batch, since)
+            except Exception as e:
+                print(f"Error migrating ticket {ticket['ticket_id']}: {e}")
+                migrated = False
+            with results_lock:
+                results['migrated' if migrated else 'failed'] += 1
+                if not migrated:
+                    results['failed_tickets'].append(ticket['ticket_id'])
+    finally:
+        kill_glpi_session(glpi)
+        close_osticket_db()
+
+def skip_completed_tickets(tickets, results, results_lock):
+    # Works on tickets and on (ticket, batch) pairs
+    for item in tickets:
+        ticket = item[0] if isinstance(item, tuple) else item
+        if is_ticket_completed(ticket['ticket_id']):
+            with results_lock:
+                results['skipped'] += 1
+            continue
+        yield item
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+def progress_line(results, results_lock, total, elapsed, detail=None):
+    with results_lock:
+        done = results['migrated'] + results['failed']
+        failed = results['failed']
+        skipped = results['skipped']
+    rate = done / elapsed if elapsed else 0
+    remaining = max(0, total - done - skipped) if total else 0
+    eta = format_duration(remaining / rate) if rate else "unknown"
+    if detail is None:
+        slowest = sorted(metrics.summary().items(), key=lambda item: item[1]['total_seconds'], reverse=True)[:3]
+        detail = ", ".join(f"{stage} {entry['count']}x {entry['mean_seconds']:.3f}s" for stage, entry in slowest)
+    return (f"Progress: {done + skipped}/{total or '?'} tickets ({failed} failed), "
+            f"{rate:.2f} tickets/s, elapsed {format_duration(elapsed)}, ETA {eta} | {detail}")
+
+def report_progress(results, results_lock, total, start, stop, interval):
+    while not stop.wait(interval):
+        print(progress_line(results, results_lock, total, time.monotonic() - start))
+
+def publish_progress(results, results_lock, shared, stop, interval=1):
+    # Copies a shard's counters to the coordinator until stop is set, then a last time
+    while True:
+        stopped = stop.wait(interval)
+        with results_lock:
+            shared[:] = [results['migrated'], results['failed'], results['skipped']]
+        if stopped:
+            return
+
+def write_metrics_report(path, report):
+    with open(path, 'w') as file:
+        json.dump(report, file, indent=2, default=str)
+
+def dry_run_report(plan, args, elapsed):
+    # Print what the dry run would have sent and how long the real run should take. Latencies
+    # come from an earlier metrics report if given, otherwise from the GLPI reads of this run.
+    summary = plan.summary()
+    if args.latency_report:
+        with open(args.latency_report) as f:
+            latencies = json.load(f)['stages']
+        source = args.latency_report
+    else:
+        latencies = {stage: entry for stage, entry in metrics.summary().items() if stage.startswith("glpi.")}
+        source = "the GLPI reads of this dry run"
+    estimate = plan.estimate(latencies, elapsed, args.workers, args.rate)
+    print("Dry run, nothing was written to GLPI or to the state file. Planned GLPI requests:")
+    for endpoint, count in summary['requests'].items():
+        print(f"  {endpoint}: {count} requests, {summary['bytes'][endpoint] / 1024 / 1024:.1f} MB")
+    print(f"Total: {sum(summary['requests'].values())} requests, {sum(summary['bytes'].values()) / 1024 / 1024:.1f} MB "
+          f"of which {summary['upload_bytes'] / 1024 / 1024:.1f} MB of attachment uploads")
+    print(f"User lookups: {glpi_user_cache_stats['hits']} answered by the cache, "
+          f"{glpi_user_cache_stats['misses']} searched in GLPI")
+    print(f"Estimated duration: {format_duration(estimate)} with {args.workers} worker(s), from the latencies of {source}")
+    return dict(summary, user_lookups_cached=glpi_user_cache_stats['hits'],
+                user_lookups_searched=glpi_user_cache_stats['misses'], estimated_seconds=round(estimate, 1))
+
+def iter_ticket_batches(tickets, batch_size):
+    # Group tickets into batches and prefetch their threads, collaborators and attachments
+    # in bulk; a batch_size of 0 keeps the per-ticket queries
+    batch = []
+    for ticket in tickets:
+        batch.append(ticket)
+        if len(batch) >= batch_size:
+            yield batch, prefetch_ticket_batch([t['ticket_id'] for t in batch]) if batch_size else None
+            batch = []
+    if batch:
+        yield batch, prefetch_ticket_batch([t['ticket_id'] for t in batch])
+
+def export_archive(args):
+    # Write tickets, threads, collaborators and attachment metadata as gzipped NDJSON
+    # (one ticket per line) plus content-addressed attachment blobs, so the import can
+    # replay them into GLPI from another host without access to osTicket
+    os.makedirs(os.path.join(args.archive, 'blobs'), exist_ok=True)
+    sync_mark = osticket_sync_mark()
+    tickets_path = os.path.join(args.archive, 'tickets.ndjson.gz')
+    exported_blobs = {}  # osTicket file_id -> blob, files attached to many entries are read once
+    counts = {'tickets': 0, 'entries': 0, 'attachments': 0, 'blobs': 0, 'missing_files': 0}
+    start = time.monotonic()
+    try:
+        with gzip.open(tickets_path + '.tmp', 'wt', encoding='utf-8') as out:
+            tickets = iter_osticket_tickets(args.from_id, args.to_id, args.chunk_size)
+            for tickets, batch in iter_ticket_batches(tickets, args.batch_size):
+                for ticket in tickets:
+                    threads = get_ticket_threads(ticket['ticket_id'], batch)
+                    attachments = {}
+                    for thread in threads:
+                        thread_attachments = get_osticket_attachments(thread['id'], batch)
                         for attachment in thread_attachments:
-                            file_content = get_file_content(attachment['file_id'])
-                            document_id = add_document_to_glpi_ticket(session_token, glpi_ticket['id'], attachment, file_content, thread, entity_id)
-                            if document_id is None:
-                                print(f"Failed to add attachment {attachment['attachment_name']} to ticket {glpi_ticket['id']}")
-                            # else:
-                                # print(f"Successfully added attachment {attachment['attachment_name']} (Document ID: {document_id}) to ticket {glpi_ticket['id']}")
-                    else:
-                        print(f"Failed to add followup to ticket {glpi_ticket['id']}")
-                else:
-                    thread_attachments = get_osticket_attachments(thread['id'])
-                    for attachment in thread_attachments:
-                        file_content = get_file_content(attachment['file_id'])
-                        document_id = add_document_to_glpi_ticket(session_token, glpi_ticket['id'], attachment, file_content, thread, entity_id)
-                        if document_id is None:
-                            print(f"Failed to add attachment {attachment['attachment_name']} to ticket {glpi_ticket['id']}")
-                        # else:
-                            # print(f"Successfully added attachment {attachment['attachment_name']} (Document ID: {document_id}) to ticket {glpi_ticket['id']}")
-                first = False
-
+                            if attachment['file_id'] not in exported_blobs:
+                                exported_blobs[attachment['file_id']] = export_blob(args.archive, attachment)
+                                counts['blobs' if exported_blobs[attachment['file_id']] else 'missing_files'] += 1
+                            attachment['blob'] = exported_blobs[attachment['file_id']]
+                        if thread_attachments:
+                            attachments[thread['id']] = thread_attachments
+                        counts['attachments'] += len(thread_attachments)
+                    record = {
+                        'ticket': ticket,
+                        'collaborators': get_ticket_collaborators(ticket['ticket_id'], batch),
+                        'threads': threads,
+                        'attachments': attachments
+                    }
+                    out.write(json.dumps(record, default=str) + "\n")
+                    counts['tickets'] += 1
+                    counts['entries'] += len(threads)
+        os.replace(tickets_path + '.tmp', tickets_path)
+    finally:
+        close_osticket_db()
+
+    manifest = dict(counts, from_id=args.from_id, to_id=args.to_id, exported=str(datetime.now()), sync_mark=sync_mark)
+    with open(os.path.join(args.archive, 'manifest.json'), 'w') as file:
+        json.dump(manifest, file, indent=2)
+    print(f"Exported {counts['tickets']} tickets, {counts['entries']} thread entries and "
+          f"{counts['attachments']} attachments ({counts['blobs']} distinct files, {counts['missing_files']} missing) "
+          f"to {args.archive} in {time.monotonic() - start:.1f}s")
+
+def iter_archive(path):
+    # Replay an exported archive as (ticket, batch) pairs, the batch holding that ticket's
+    # threads, collaborators and attachments in the same shape as prefetch_ticket_batch
+    with gzip.open(os.path.join(path, 'tickets.ndjson.gz'), 'rt', encoding='utf-8') as archive:
+        for line in archive:
+            record = json.loads(line)
+            ticket = record['ticket']
+            batch = {
+                'threads': {ticket['ticket_id']: record['threads']},
+                'collaborators': {ticket['ticket_id']: record['collaborators']},
+                'attachments': {int(entry_id): rows for entry_id, rows in record['attachments'].items()}
+            }
+            yield ticket, batch
+
+def read_archive_manifest(path):
+    with open(os.path.join(path, 'manifest.json')) as file:
+        return json.load(file)
+
+def default_user_cache(args):
+    # Next to the state file, so every process working on that state shares the users
+    return args.user_cache or os.path.splitext(args.state)[0] + "_users.db"
+
+def main(args=None, shared_progress=None):
+    global stream_attachments, deduplicate_attachments, inline_attachments, bulk_write_size, archive_dir
+    global attachment_prefetcher, attachment_prefetch_max_file, dry_run_plan
+    if args is None:
+        args = parse_args([])
+    stream_attachments = args.stream_attachments
+    deduplicate_attachments = not args.no_dedup_attachments
+    bulk_write_size = args.bulk_size
+    inline_attachments = args.inline_attachments
+    attachment_prefetch_max_file = args.prefetch_max_file_mb * 1024 * 1024
+    workers = args.workers
+    results = {'migrated': 0, 'failed': 0, 'skipped': 0, 'failed_tickets': []}
+    results_lock = threading.Lock()
+    start = time.monotonic()
+    # Every worker's GLPI session shares one pool of keep-alive connections
+    http = make_http_session(args.pool_size or workers)
+    scheduler = RequestScheduler(rate=args.rate, burst=args.burst, max_retries=args.max_retries,
+                                 max_concurrency=args.max_concurrency or workers,
+                                 target_latency=args.target_latency, timeout=(10, args.timeout))
+    dry_run_plan = DryRunPlan() if args.dry_run else None
+
+    if args.command != 'import':
+        load_osticket_dimensions()
+        print(f"Loaded {len(osticket_staff)} osTicket staff and {len(osticket_users)} users")
+    if not args.no_validate:
+        glpi = init_glpi_session(http, scheduler)
+        try:
+            validate_mappings(glpi, args.from_id, args.to_id, check_osticket=args.command != 'import')
+        finally:
+            kill_glpi_session(glpi)
+
+    mapped = open_mapping_store(args.state, in_memory=args.dry_run)
+    if mapped and not args.resume and args.command != 'sync':
+        close_mapping_store()
+        raise Exception(f"{args.state} already maps {mapped} tickets, use --resume to continue that migration "
+                        f"or move the file away to start over")
+    since = get_sync_mark() if args.command == 'sync' else None
+    if args.command == 'sync' and since is None:
+        close_mapping_store()
+        raise Exception(f"{args.state} has no high-water mark, run the migration before syncing")
+    user_cache = default_user_cache(args)
+    if not args.dry_run or os.path.exists(user_cache):
+        cached = open_glpi_user_cache(user_cache)
+        print(f"Loaded {cached} cached GLPI users from {user_cache}")
+        if args.dry_run:
+            # Keep the loaded users but never write the made-up ids to the file
+            close_glpi_user_cache()
+    if args.prewarm_users:
+        glpi = init_glpi_session(http, scheduler)
+        try:
+            print(f"Prewarmed user cache with {prewarm_glpi_user_cache(glpi)} GLPI users")
+        finally:
+            kill_glpi_session(glpi)
+
+    sync_mark = None
+    if args.command == 'sync':
+        # Only tickets changed since the last run, completed ones included
+        sync_mark = osticket_sync_mark()
+        ticket_ids = changed_osticket_ticket_ids(since, args.from_id, args.to_id)
+        total = len(ticket_ids)
+        print(f"{total} tickets changed since {since}")
+        tickets = iter_osticket_tickets_by_id(ticket_ids, args.chunk_size)
+        items = ((ticket, batch) for tickets, batch in iter_ticket_batches(tickets, args.batch_size) for ticket in tickets)
+    elif args.command == 'import':
+        archive_dir = args.archive
+        manifest = read_archive_manifest(args.archive)
+        total = manifest['tickets']
+        if manifest.get('sync_mark'):
+            record_sync_mark(manifest['sync_mark'], replace=False)
+        items = iter_archive(args.archive)
+        if args.resume:
+            items = skip_completed_tickets(items, results, results_lock)
+    else:
+        # The first run decides where the first delta sync starts
+        record_sync_mark(osticket_sync_mark(), replace=False)
+        total = count_osticket_tickets(args.from_id, args.to_id)
+        tickets = iter_osticket_tickets(args.from_id, args.to_id, args.chunk_size)
+        if args.resume:
+            tickets = skip_completed_tickets(tickets, results, results_lock)
+        items = ((ticket, batch) for tickets, batch in iter_ticket_batches(tickets, args.batch_size) for ticket in tickets)
+    stop_progress = threading.Event()
+    if args.progress_interval:
+        threading.Thread(target=report_progress, args=(results, results_lock, total, start, stop_progress,
+                                                       args.progress_interval), daemon=True).start()
+    publisher = None
+    if shared_progress is not None:
+        publisher = threading.Thread(target=publish_progress, args=(results, results_lock, shared_progress, stop_progress),
+                                     daemon=True)
+        publisher.start()
+
+    if args.prefetch_threads:
+        attachment_prefetcher = AttachmentPrefetcher(args.prefetch_threads, args.prefetch_mb * 1024 * 1024)
+    # Bounded queue so the reader never runs far ahead of the workers
+    ticket_queue = queue.Queue(maxsize=workers * 2)
+    threads = [
+        threading.Thread(target=migration_worker, args=(ticket_queue, results, results_lock, http, scheduler, since),
+                         daemon=True)
+        for _ in range(workers)
+    ]
+    for thread in threads:
+        thread.start()
+    fed_all = False
+    try:
+        for item in items:
+            while True:
+                if not any(thread.is_alive() for thread in threads):
+                    raise Exception("All migration workers stopped")
+                try:
+                    ticket_queue.put(item, timeout=1)
+                    break
+                except queue.Full:
+                    pass
+        fed_all = True
+    finally:
+        for thread in threads:
+            if thread.is_alive():
+                ticket_queue.put(None)
+        for thread in threads:
+            thread.join()
+        stop_progress.set()
+        if publisher is not None:
+            publisher.join()
+        if attachment_prefetcher is not None:
+            attachment_prefetcher.close()
+            attachment_prefetcher = None
+        # Move the mark only when every changed ticket made it, otherwise the next sync retries them
+        if sync_mark is not None and fed_all and not results['failed'] and not args.dry_run:
+            record_sync_mark(sync_mark)
+            print(f"Next sync picks up changes from {sync_mark}")
+        close_osticket_db()
+        close_glpi_user_cache()
+        close_mapping_store()
+
+    elapsed = time.monotonic() - start
+    total_done = results['migrated'] + results['failed']
+    print(f"{'Walked' if args.dry_run else 'Migrated'} {results['migrated']} tickets ({results['failed']} failed or incomplete) in {elapsed:.1f}s "
+          f"with {workers} worker(s): {total_done / elapsed if elapsed else 0:.2f} tickets/s")
+    print(f"GLPI requests: {scheduler.stats['requests']} sent, {scheduler.stats['retries']} retried, "
+          f"{scheduler.stats['throttled']} throttled (429), {scheduler.stats['gave_up']} gave up, "
+          f"final concurrency limit {int(scheduler.limit)}")
+    print(f"User cache: {glpi_user_cache_stats['hits']} hits, {glpi_user_cache_stats['misses']} misses")
+    dry_run = None
+    if dry_run_plan is not None:
+        dry_run = dry_run_report(dry_run_plan, args, elapsed)
+        dry_run_plan = None
+    if args.metrics_report:
+        write_metrics_report(args.metrics_report, {
+            'workers': workers,
+            'batch_size': args.batch_size,
+            'elapsed_seconds': round(elapsed, 3),
+            'tickets': dict(results, total=total),
+            'tickets_per_second': round(total_done / elapsed, 3) if elapsed else 0,
+            'glpi_requests': dict(scheduler.stats, final_concurrency_limit=int(scheduler.limit)),
+            'user_cache': dict(glpi_user_cache_stats),
+            'stages': metrics.summary(),
+            **({'dry_run': dry_run} if dry_run is not None else {})
+        })
+        print(f"Metrics report written to {args.metrics_report}")
+    if dry_run is None:
         print("Migration completed successfully!")
+
+# Relative cost of the parts of a ticket, roughly the GLPI requests and bytes each one needs,
+# used to give every shard about the same amount of work
+shard_weights = {'ticket': 3, 'entry': 1, 'attachment': 4}
+
+def plan_shards(shards, from_id=None, to_id=None):
+    # Split the ticket_id range into at most `shards` contiguous ranges of about equal weight.
+    # Tickets, thread entries and attachments are counted per bucket of ids, so the plan
+    # costs three grouped queries whatever the number of tickets.
+    cursor = get_osticket_db().cursor(dictionary=True)
+    bounds = timed_fetchall("mysql.plan_shards", cursor,
+                            "SELECT MIN(ticket_id) AS low, MAX(ticket_id) AS high FROM ost_ticket "
+                            "WHERE ticket_id >= %s AND ticket_id <= %s",
+                            (from_id if from_id is not None else 0, to_id if to_id is not None else 2 ** 62))[0]
+    if bounds['low'] is None:
+        return []
+    low, high = bounds['low'], bounds['high']
+    bucket_size = max(1, (high - low + 1) // (shards * 100))
+    params = (low, bucket_size, low, high)
+    queries = {
+        'ticket': """
+        SELECT FLOOR((ticket_id - %s) / %s) AS bucket, COUNT(*) AS count
+        FROM ost_ticket
+        WHERE ticket_id BETWEEN %s AND %s
+        GROUP BY bucket
+        """,
+        'entry': """
+        SELECT FLOOR((th.object_id - %s) / %s) AS bucket, COUNT(*) AS count
+        FROM ost_thread th
+        JOIN ost_thread_entry te ON te.thread_id = th.id
+        WHERE th.object_type = 'T' AND th.object_id BETWEEN %s AND %s
+        GROUP BY bucket
+        """,
+        'attachment': """
+        SELECT FLOOR((th.object_id - %s) / %s) AS bucket, COUNT(*) AS count
+        FROM ost_thread th
+        JOIN ost_thread_entry te ON te.thread_id = th.id
+        JOIN ost_attachment a ON a.object_id = te.id AND a.type = 'H'
+        WHERE th.object_type = 'T' AND th.object_id BETWEEN %s AND %s
+        GROUP BY bucket
+        """
+    }
+    weights = collections.Counter()
+    tickets = collections.Counter()
+    for kind, query in queries.items():
+        for row in timed_fetchall("mysql.plan_shards", cursor, query, params):
+            weights[int(row['bucket'])] += row['count'] * shard_weights[kind]
+            if kind == 'ticket':
+                tickets[int(row['bucket'])] += row['count']
+
+    total = sum(weights.values())
+    plan = []
+    shard = {'from_id': low, 'tickets': 0, 'weight': 0}
+    done = 0
+    for bucket in sorted(weights):
+        shard['tickets'] += tickets[bucket]
+        shard['weight'] += weights[bucket]
+        done += weights[bucket]
+        if len(plan) < shards - 1 and done >= total * (len(plan) + 1) / shards:
+            shard['to_id'] = low + (bucket + 1) * bucket_size - 1
+            plan.append(shard)
+            shard = {'from_id': shard['to_id'] + 1, 'tickets': 0, 'weight': 0}
+    if shard['weight']:
+        shard['to_id'] = high
+        plan.append(shard)
+    return plan
+
+def run_shard(args, shared_progress):
+    # Entry point of a shard process, forked from the coordinator. It has its own MySQL
+    # connections, GLPI sessions and metrics, and shares the state and user cache files.
+    global metrics
+    metrics = MigrationMetrics()
+    main(args, shared_progress)
+
+def run_shards(args):
+    # Coordinator for --shards: plan the ranges, run one process per range and merge their
+    # progress and reports
+    if args.command in ('import', 'sync'):
+        raise Exception(f"--shards splits a full migration from osTicket, run {args.command} with --workers instead")
+    if args.dry_run:
+        raise Exception("--dry-run plans the whole range in one process, run it with --workers instead of --shards")
+    start = time.monotonic()
+    mapped = open_mapping_store(args.state)
+    close_mapping_store()
+    if mapped and not args.resume:
+        raise Exception(f"{args.state} already maps {mapped} tickets, use --resume to continue that migration "
+                        f"or move the file away to start over")
+    try:
+        plan = plan_shards(args.shards, args.from_id, args.to_id)
     finally:
-        kill_glpi_session(session_token)
+        close_osticket_db()
+    total = sum(shard['tickets'] for shard in plan)
+    if not args.no_validate:
+        http = make_http_session(1)
+        glpi = init_glpi_session(http)
+        try:
+            validate_mappings(glpi, args.from_id, args.to_id)
+        finally:
+            kill_glpi_session(glpi)
+            http.close()
+    # Loaded once here and inherited by every forked shard
+    load_osticket_dimensions()
+    close_osticket_db()
+    for index, shard in enumerate(plan):
+        print(f"Shard {index}: tickets {shard['from_id']}-{shard['to_id']}, {shard['tickets']} tickets, weight {shard['weight']}")
+
+    # Users are shared between shards through one cache file, prewarmed once here and
+    # inherited by every forked shard
+    user_cache = default_user_cache(args)
+    if args.prewarm_users:
+        http = make_http_session(1)
+        glpi = init_glpi_session(http)
+        try:
+            print(f"Prewarmed user cache with {prewarm_glpi_user_cache(glpi)} GLPI users")
+        finally:
+            kill_glpi_session(glpi)
+            http.close()
+
+    report_dir = tempfile.TemporaryDirectory()
+    context = multiprocessing.get_context("fork")
+    shards = []
+    for index, shard in enumerate(plan):
+        shard_args = argparse.Namespace(**vars(args))
+        shard_args.from_id = shard['from_id']
+        shard_args.to_id = shard['to_id']
+        shard_args.resume = True  # checked above, shards only skip what is already completed
+        shard_args.prewarm_users = False
+        shard_args.no_validate = True
+        shard_args.user_cache = user_cache
+        shard_args.progress_interval = 0
+        shard_args.metrics_report = os.path.join(report_dir.name, f"shard{index}.json")
+        progress = context.Array('q', 3)
+        process = context.Process(target=run_shard, args=(shard_args, progress), name=f"shard{index}")
+        process.start()
+        shards.append((shard, shard_args, progress, process))
+
+    results_lock = threading.Lock()
+    last_report = time.monotonic()
+    while True:
+        running = [process for _, _, _, process in shards if process.is_alive()]
+        if not running:
+            break
+        running[0].join(1)
+        if args.progress_interval and time.monotonic() - last_report >= args.progress_interval:
+            last_report = time.monotonic()
+            results = {key: sum(progress[i] for _, _, progress, _ in shards)
+                       for i, key in enumerate(('migrated', 'failed', 'skipped'))}
+            print(progress_line(results, results_lock, total, last_report - start,
+                                f"{len(running)}/{len(shards)} shards running"))
+
+    merged = MigrationMetrics()
+    report = {'shards': [], 'tickets': {'migrated': 0, 'failed': 0, 'skipped': 0, 'failed_tickets': [], 'total': total},
+              'glpi_requests': collections.Counter(), 'user_cache': collections.Counter()}
+    crashed = []
+    for index, (shard, shard_args, progress, process) in enumerate(shards):
+        entry = dict(shard, exit_code=process.exitcode)
+        if process.exitcode != 0 or not os.path.exists(shard_args.metrics_report):
+            crashed.append(index)
+            report['shards'].append(entry)
+            continue
+        with open(shard_args.metrics_report) as file:
+            shard_report = json.load(file)
+        merged.merge(shard_report['stages'])
+        for key in ('migrated', 'failed', 'skipped', 'failed_tickets'):
+            report['tickets'][key] += shard_report['tickets'][key]
+        report['glpi_requests'].update({key: value for key, value in shard_report['glpi_requests'].items()
+                                        if key != 'final_concurrency_limit'})
+        report['user_cache'].update(shard_report['user_cache'])
+        entry.update(elapsed_seconds=shard_report['elapsed_seconds'], results=shard_report['tickets'])
+        report['shards'].append(entry)
+    report_dir.cleanup()
+
+    elapsed = time.monotonic() - start
+    results = report['tickets']
+    results['failed_tickets'].sort()
+    total_done = results['migrated'] + results['failed']
+    print(f"Migrated {results['migrated']} tickets ({results['failed']} failed or incomplete) in {elapsed:.1f}s "
+          f"with {len(shards)} shard(s) of {args.workers} worker(s): {total_done / elapsed if elapsed else 0:.2f} tickets/s")
+    if results['failed_tickets']:
+        print(f"Failed tickets: {', '.join(str(ticket_id) for ticket_id in results['failed_tickets'])}")
+    if args.metrics_report:
+        report.update(elapsed_seconds=round(elapsed, 3), workers=args.workers, batch_size=args.batch_size,
+                      tickets_per_second=round(total_done / elapsed, 3) if elapsed else 0, stages=merged.summary())
+        write_metrics_report(args.metrics_report, report)
+        print(f"Metrics report written to {args.metrics_report}")
+    if crashed:
+        raise Exception(f"Shard(s) {', '.join(map(str, crashed))} stopped with an error, run again with --resume")
+    print("Migration completed successfully!")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Migrate osTicket tickets to GLPI")
+    parser.add_argument("command", nargs="?", default="migrate", choices=["migrate", "export", "import", "sync"],
+                        help="migrate straight from osTicket to GLPI (default), export osTicket to an archive, "
+                             "import an archive into GLPI, or sync what changed in osTicket since the last run")
+    parser.add_argument("--archive", default="osticket_export",
+                        help="directory of the export archive (tickets.ndjson.gz, manifest.json and blobs/)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of concurrent workers, each with its own GLPI session and MySQL connection")
+    parser.add_argument("--shards", type=int, default=1,
+                        help="processes to split the ticket_id range into, balanced on entries and attachments; "
+                             "each runs --workers workers")
+    parser.add_argument("--batch-size", type=int, default=100,
+                        help="tickets whose threads, collaborators and attachments are prefetched together (0 = per-ticket queries)")
+    parser.add_argument("--from-id", type=int, default=None,
+                        help="first osTicket ticket_id to migrate (inclusive)")
+    parser.add_argument("--to-id", type=int, default=None,
+                        help="last osTicket ticket_id to migrate (inclusive)")
+    parser.add_argument("--chunk-size", type=int, default=500,
+                        help="tickets read from osTicket per keyset-paginated query")
+    parser.add_argument("--user-cache", default=None,
+                        help="SQLite file that persists the email -> GLPI user id cache between runs and processes "
+                             "(default: the --state file name with _users.db)")
+    parser.add_argument("--prewarm-users", action="store_true",
+                        help="load all GLPI users with one paginated search before migrating")
+    parser.add_argument("--state", default="migration_state.db",
+                        help="SQLite file mapping osTicket ids to the GLPI ids created for them")
+    parser.add_argument("--resume", action="store_true",
+                        help="skip tickets completed in a previous run and finish partly migrated ones")
+    parser.add_argument("--stream-attachments", action="store_true",
+                        help="upload attachments as streamed multipart bodies with bounded memory per upload")
+    parser.add_argument("--no-dedup-attachments", action="store_true",
+                        help="upload every attachment again instead of linking files that were already uploaded")
+    parser.add_argument("--prefetch-threads", type=int, default=4,
+                        help="background threads reading attachments ahead of the uploads (0 = read when uploading)")
+    parser.add_argument("--prefetch-mb", type=int, default=64,
+                        help="attachment content read ahead at most, in MB, shared by all workers")
+    parser.add_argument("--prefetch-max-file-mb", type=int, default=8,
+                        help="attachments larger than this are streamed during the upload instead of read ahead")
+    parser.add_argument("--no-validate", action="store_true",
+                        help="skip checking the department, status and staff maps and the help topics against GLPI")
+    parser.add_argument("--inline-attachments", action="store_true",
+                        help="upload a followup's attachments in the followup request itself instead of as "
+                             "separate Document and Document_Item requests")
+    parser.add_argument("--bulk-size", type=int, default=50,
+                        help="followups, watchers and document links created per GLPI request (1 = one request each)")
+    parser.add_argument("--pool-size", type=int, default=None,
+                        help="keep-alive connections kept open to GLPI (default: one per worker)")
+    parser.add_argument("--rate", type=float, default=0,
+                        help="maximum GLPI requests per second across all workers (0 = unlimited)")
+    parser.add_argument("--burst", type=int, default=None,
+                        help="GLPI requests allowed at once above --rate (default: one second worth)")
+    parser.add_argument("--max-retries", type=int, default=5,
+                        help="retries for GLPI requests that time out or get 429/502/503/504 (writes: only when not received or 429/503)")
+    parser.add_argument("--max-concurrency", type=int, default=None,
+                        help="upper bound for concurrent GLPI requests, adapted to response times (default: --workers)")
+    parser.add_argument("--target-latency", type=float, default=1.0,
+                        help="GLPI response time in seconds above which concurrency is reduced")
+    parser.add_argument("--timeout", type=float, default=120,
+                        help="seconds to wait for a GLPI response before retrying")
+    parser.add_argument("--progress-interval", type=float, default=30,
+                        help="seconds between progress lines with per-stage timings and ETA (0 = off)")
+    parser.add_argument("--metrics-report", default="migration_metrics.json",
+                        help="JSON file for the final per-stage latency, count and bytes report")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="read osTicket and look users up in GLPI as a migrate, import or sync would, but only "
+                             "count the GLPI writes, bytes and user lookups and estimate the duration")
+    parser.add_argument("--latency-report", default=None,
+                        help="metrics report of an earlier run whose per-endpoint latencies --dry-run estimates with "
+                             "(default: the latencies of the dry run's own GLPI reads)")
+    parser.add_argument("--explain", action="store_true",
+                        help="print the EXPLAIN plan of the ticket query and exit")
+    return parser.parse_args(argv)
 
 if __name__ == "__main__":
-    main()
+    args = parse_args()
+    if args.explain:
+        explain_osticket_tickets(args.chunk_size)
+        raise SystemExit(0)
+    if args.command == "export":
+        export_archive(args)
+    elif args.shards > 1:
+        run_shards(args)
+    else:
+        main(args)
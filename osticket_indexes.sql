@@ -0,0 +1,34 @@
+-- Recommended indexes for the migration queries on an osTicket v1.18 database.
+-- Check the plan before and after with: python migration.py --explain
+--
+-- The ticket listing groups ost_thread by ticket, and every thread fetch reads
+-- and sorts the entries of its threads. --explain prints the plan of one page
+-- of the ticket listing and warns when ost_thread, inside the grouped derived
+-- table, is read with a full scan (type=ALL).
+
+-- get_ticket_threads and the batch prefetch read a thread's entries in
+-- (created, id) order, the first of which is the ticket description.
+CREATE INDEX idx_migration_thread_created ON ost_thread_entry (thread_id, created, id);
+
+-- Thread lookup by ticket: WHERE object_type = 'T' GROUP BY object_id, and the
+-- t.object_id IN (...) filters of the batched extraction.
+CREATE INDEX idx_migration_thread_object ON ost_thread (object_type, object_id, id);
+
+-- Delta sync (python migration.py sync): tickets updated and thread entries
+-- created or edited since the high-water mark, one range scan each.
+CREATE INDEX idx_migration_ticket_lastupdate ON ost_ticket (lastupdate);
+CREATE INDEX idx_migration_entry_created ON ost_thread_entry (created);
+CREATE INDEX idx_migration_entry_updated ON ost_thread_entry (updated);
+
+-- Already covered by the stock schema, listed for completeness:
+--   ost_attachment        UNIQUE (object_id, file_id, type)  -> attachments by thread entry
+--   ost_thread_collaborator UNIQUE (thread_id, user_id)       -> collaborators by thread
+--   ost_file_chunk        PRIMARY KEY (file_id, chunk_id)      -> database-stored file chunks
+--   ost_user_email        PRIMARY KEY (id), KEY (user_id)      -> requester email lookup
+
+-- Drop them again once the migration is finished:
+-- DROP INDEX idx_migration_thread_created ON ost_thread_entry;
+-- DROP INDEX idx_migration_thread_object ON ost_thread;
+-- DROP INDEX idx_migration_ticket_lastupdate ON ost_ticket;
+-- DROP INDEX idx_migration_entry_created ON ost_thread_entry;
+-- DROP INDEX idx_migration_entry_updated ON ost_thread_entry;